@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+from krec_metrics import peak_rss
+from krec_stream import Event, scan_records
+from krec_synth import write_recording
+
+
+STAGES: dict[str, Callable] = {}
+
+
+def stage(name: str):
+    def register(setup: Callable):
+        STAGES[name] = setup
+        return setup
+    return register
+
+
+# each stage does its untimed setup and returns the callable to time
+@stage('Krec.from_file')
+def krec_from_file(path: str, tmpdir: str):
+    from lib.krec import Krec
+    return lambda: Krec.from_file(path)
+
+
+@stage('KrecPj64k.from_file')
+def krec_pj64k_from_file(path: str, tmpdir: str):
+    from lib.krec_pj64k import KrecPj64k
+    return lambda: KrecPj64k.from_file(path)
+
+
+@stage('info.get_stats')
+def info_get_stats(path: str, tmpdir: str):
+    import info
+    from lib.krec import Krec
+    krec = Krec.from_file(path)
+    return lambda: info.get_stats(krec.playback)
+
+
+def _bizhawk(path: str):
+    import krec_to_bk2
+    from bizhawk import BizHawk, Game
+
+    krec = krec_to_bk2.Krec.from_file(path)
+    values = [(frame, event) for frame, event in enumerate(krec.playback)
+              if event.type == krec_to_bk2.Krec.Playback.Event.values]
+    ports = krec_to_bk2.determine_ports(values[0:100])
+    game = Game(krec.header.game_name, '', '0' * 40)
+    bizhawk = BizHawk(2.8, BizHawk.Core.MUPEN64PLUS, game, ports)
+    return bizhawk, values, ports
+
+
+@stage('krec_to_bk2.parse_inputs')
+def krec_to_bk2_parse_inputs(path: str, tmpdir: str):
+    import krec_to_bk2
+    bizhawk, values, ports = _bizhawk(path)
+    mapping = krec_to_bk2.krec_mapping(bizhawk)
+    return lambda: list(krec_to_bk2.parse_inputs(values, mapping, ports))
+
+
+@stage('BizHawk.build_bk2')
+def bizhawk_build_bk2(path: str, tmpdir: str):
+    import krec_to_bk2
+    bizhawk, values, ports = _bizhawk(path)
+    mapping = krec_to_bk2.krec_mapping(bizhawk)
+    inputs = list(krec_to_bk2.parse_inputs(values, mapping, ports))
+    output = os.path.join(tmpdir, 'benchmark.bk2')
+    return lambda: bizhawk.build_bk2(path, inputs, output)
+
+
+# modules timed on import, and tool runs, each in a new interpreter
+STARTUP_IMPORTS = ('info', 'krec_to_bk2', 'bizhawk', 'krec_formats')
+STARTUP_RUNS = {
+    'info.py -H': ['info.py', '-H'],
+    'info.py': ['info.py'],
+}
+
+
+def startup(path: str, repeat: int) -> dict:
+    # seconds over a bare interpreter, best of repeat runs
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [directory, env.get('PYTHONPATH')]))
+
+    def best(argv: list[str]) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *argv], env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    interpreter = best(['-c', 'pass'])
+    results = {'interpreter seconds': round(interpreter, 4)}
+    for module in STARTUP_IMPORTS:
+        results[f"import {module}"] = round(
+            best(['-c', f"import {module}"]) - interpreter, 4)
+    for name, (script, *argv) in STARTUP_RUNS.items():
+        results[name] = round(best(
+            [os.path.join(directory, script), *argv, path]) - interpreter, 4)
+    return results
+
+
+def count_events(path: str) -> dict:
+    with open(path, 'rb') as stream:
+        data = stream.read()
+    events = {event.name.lower(): 0 for event in Event}
+    for offset, _ in scan_records(data):
+        events[Event(data[offset]).name.lower()] += 1
+    return events
+
+
+def run_stage(name: str, path: str, tmpdir: str, repeat: int) -> dict:
+    # runs in a fresh process so peak rss belongs to this stage only
+    run = STAGES[name](path, tmpdir)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds': round(min(times), 4),
+        'peak rss KiB': peak_rss() // 1024,
+        'alloc peak bytes': peak,
+        'retained blocks': sys.getallocatedblocks() - blocks,
+    }
+
+
+def compare(results: dict, baseline: dict):
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if not before:
+            continue
+        speedup = stage['events/s'] / max(before['events/s'], 1)
+        memory = stage['peak rss KiB'] / max(before['peak rss KiB'], 1)
+        print(f"{name}: {speedup:.2f}x events/s, {memory:.2f}x peak rss")
+
+    for name, seconds in results.get('startup', {}).items():
+        before = baseline.get('startup', {}).get(name)
+        if before:
+            print(f"startup {name}: {seconds / before:.2f}x seconds")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Times the krec parser and bk2 converter hot paths'
+    ))
+
+    parser.add_argument('-k', metavar='KREC', dest='krec',
+                        help='benchmark this recording instead of a '
+                        'synthetic one')
+    parser.add_argument('-f', metavar='FRAMES', type=int, dest='frames',
+                        help='synthetic frames (default: 36000)')
+    parser.add_argument('-p', metavar='PLAYERS', type=int, dest='players',
+                        help='synthetic players (default: 2)')
+    parser.add_argument('-c', metavar='INTERVAL', type=int, dest='chats',
+                        help='synthetic frames between chats (default: 600)')
+    parser.add_argument('-d', metavar='DROPS', type=int, dest='drops',
+                        help='synthetic drop events (default: 1)')
+    parser.add_argument('-n', metavar='REPEAT', type=int, dest='repeat',
+                        help='timed runs per stage, best is kept '
+                        '(default: 3)')
+    parser.add_argument('-s', metavar='STAGE', dest='stages', nargs='+',
+                        choices=list(STAGES), help='stages to run '
+                        '(default: all)')
+    parser.add_argument('-S', dest='startup', action='store_false',
+                        help='skip the startup timings')
+    parser.add_argument('-o', metavar='JSON', dest='output',
+                        help='write results to JSON')
+    parser.add_argument('-b', metavar='JSON', dest='baseline',
+                        help='compare against earlier results')
+
+    parser.set_defaults(frames=36000, players=2, chats=600, drops=1,
+                        repeat=3, stages=list(STAGES))
+    return parser.parse_args()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.krec
+        if not path:
+            path = os.path.join(tmpdir, 'synthetic.krec')
+            write_recording(path, args.frames, args.players, args.chats,
+                            drops=args.drops)
+
+        events = count_events(path)
+        results = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'recording': {
+                'name': os.path.basename(path),
+                'bytes': os.path.getsize(path),
+                'events': sum(events.values()),
+                **events,
+            },
+            'stages': {},
+        }
+
+        spawn = multiprocessing.get_context('spawn')
+        for name in args.stages:
+            with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                stage = executor.submit(
+                    run_stage, name, path, tmpdir, args.repeat).result()
+
+            # parsers walk every event, the converter stages only frames
+            count = results['recording']['events'] \
+                if name.endswith(('from_file', 'get_stats')) \
+                else results['recording']['values']
+            stage['events/s'] = round(count / max(stage['seconds'], 1e-9))
+            results['stages'][name] = stage
+
+        if args.startup:
+            results['startup'] = startup(path, args.repeat)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -1,36 +1,72 @@
 #!/usr/bin/env python3
 
-import copy
+import dataclasses
+import functools
 import json
-import hashlib
+import io
+import operator
 import os
-import shutil
-import tempfile
-from dataclasses import dataclass
+import re
+import time
+import zipfile
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Callable, Tuple
-
-
-@dataclass
+from typing import Callable, Iterable, Optional, Tuple
+from krec_stream import CACHE_DIR
+
+ROM_HASH_CACHE = os.path.join(CACHE_DIR, 'roms.json')
+ROM_CHUNK_SIZE = 1024 * 1024
+ROM_HEADER_SIZE = 0x40
+ROM_CRC_OFFSET = 0x10
+ROM_NAME_OFFSET = 0x20
+ROM_NAME_SIZE = 20
+ROM_COUNTRY_OFFSET = 0x3e
+# words too common in titles to tell two games apart
+TITLE_STOPWORDS = {'the', 'and', 'for', 'super', 'world', 'game', 'usa',
+                   'europe', 'japan', 'rev', 'version', 'edition'}
+
+# rendered analog values, indexed directly by a signed byte (-128..127)
+AXIS_TEXT = [
+    f"{value if value < 128 else value - 256:>5}," for value in range(256)]
+
+
+@dataclass(frozen=True, slots=True)
 class Bk2Map:
     bk2_key: str
     bk2_value: str
     data_attr: str = ''
+    data_mask: int = 0          # bit of the data's button word, if any
     x_axis: bool = False
     y_axis: bool = False
 
     def swap_axis(self, swap: bool):
-        obj = copy.deepcopy(self)
-        if swap and self.x_axis:
-            obj.bk2_key = self.bk2_key.replace('X', 'Y').replace('x', 'y')
-            obj.data_attr = self.data_attr.replace('X', 'Y').replace('x', 'y')
-        if swap and self.y_axis:
-            obj.bk2_key = self.bk2_key.replace('Y', 'X').replace('y', 'x')
-            obj.data_attr = self.data_attr.replace('Y', 'X').replace('y', 'x')
-        return obj
+        if not swap or not (self.x_axis or self.y_axis):
+            return self
+        return _swapped_axis(self)
 
+    def replace(self, **changes):
+        return _interned(dataclasses.replace(self, **changes))
 
-@dataclass
+
+@functools.cache
+def _interned(map: Bk2Map) -> Bk2Map:
+    # equal maps share one instance, and with it their swapped variant
+    return map
+
+
+@functools.cache
+def _swapped_axis(map: Bk2Map) -> Bk2Map:
+    # only the axis letter changes, "X Axis" to "Y Axis" and stick_x to
+    # stick_y, not every x of the name
+    old, new = ('X', 'Y') if map.x_axis else ('Y', 'X')
+    return _interned(dataclasses.replace(
+        map,
+        bk2_key=re.sub(rf'\b{old}\b', new, map.bk2_key),
+        data_attr=re.sub(rf'_{old.lower()}\b', f"_{new.lower()}",
+                         map.data_attr)))
+
+
+@dataclass(frozen=True, slots=True)
 class Comment:
     message: str
 
@@ -38,13 +74,122 @@ class Comment:
         return f"{self.message}\r\n"
 
 
+class RomHashCache(object):
+    # sha1 of ROM files, reused while a file's size and mtime are unchanged
+    def __init__(self, path: str = ROM_HASH_CACHE):
+        self.path = path
+        self.entries: dict[str, list] = {}
+        try:
+            with open(path, 'r') as cache:
+                entries = json.load(cache)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, rom_path: str) -> str:
+        # the cached sha1, empty if the file changed or was never hashed
+        stat = os.stat(rom_path)
+        entry = self.entries.get(os.path.abspath(rom_path))
+        if isinstance(entry, list) and len(entry) == 3 and \
+                entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        return ''
+
+    def sha1(self, rom_path: str) -> str:
+        if digest := self.lookup(rom_path):
+            return digest
+
+        import hashlib
+        rom_path = os.path.abspath(rom_path)
+        stat = os.stat(rom_path)
+        digest = hashlib.sha1()
+        with open(rom_path, 'rb') as rom:
+            buffer = bytearray(ROM_CHUNK_SIZE)
+            view = memoryview(buffer)
+            while size := rom.readinto(buffer):
+                digest.update(view[:size])
+        self.entries[rom_path] = \
+            [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        self.save()
+        return digest.hexdigest()
+
+    def save(self):
+        # written whole and renamed, a reader never sees half a file
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp = f"{self.path}.{os.getpid()}"
+            with open(temp, 'w') as cache:
+                json.dump(self.entries, cache)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
+
+
+@functools.cache
+def rom_hash_cache() -> RomHashCache:
+    return RomHashCache()
+
+
 @dataclass
 class Game:
     name: str
     rom_path: str
+    digest: str = ''
 
     def sha1(self):
-        return hashlib.sha1(open(self.rom_path, 'rb').read()).hexdigest()
+        if not self.digest:
+            self.digest = rom_hash_cache().sha1(self.rom_path)
+        return self.digest
+
+    def rom_header(self) -> bytes:
+        # ROM header in big endian (.z64) order, whichever of the three byte
+        # orders the file uses; empty if it isn't an N64 ROM
+        with open(self.rom_path, 'rb') as rom:
+            header = rom.read(ROM_HEADER_SIZE)
+        if len(header) < ROM_HEADER_SIZE:
+            return b''
+
+        match header[:4]:
+            case b'\x37\x80\x40\x12':                 # .v64, 16 bit swapped
+                order = 2
+            case b'\x40\x12\x37\x80':                 # .n64, 32 bit swapped
+                order = 4
+            case b'\x80\x37\x12\x40':                 # .z64
+                order = 1
+            case _:
+                return b''
+
+        header = bytearray(header)
+        for start in range(0, len(header), order):
+            header[start:start+order] = header[start:start+order][::-1]
+        return bytes(header)
+
+    def rom_name(self) -> str:
+        name = self.rom_header()[ROM_NAME_OFFSET:ROM_NAME_OFFSET+ROM_NAME_SIZE]
+        return name.decode('ascii', 'replace').strip(' \0')
+
+    def matches(self) -> bool:
+        # loose check of the krec's game name against the ROM's internal
+        # name, they rarely agree exactly ("SMASH BROTHERS" for
+        # "Super Smash Bros. (U) [!]"), so one shared word is enough as
+        # long as it isn't one most titles have
+        if not self.name:
+            return True
+        rom_name = self.rom_name()
+        if not rom_name:
+            return False
+        return bool(_words(self.name) & _words(rom_name)) or \
+            _squash(self.name).startswith(_squash(rom_name))
+
+
+def _squash(name: str) -> str:
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def _words(name: str) -> set[str]:
+    return set(word for word in re.findall(r'[a-z0-9]+', name.lower())
+               if len(word) > 2 and word not in TITLE_STOPWORDS)
 
 
 @dataclass
@@ -73,36 +218,110 @@ class Header:
         )
 
 
-@dataclass
+class InputRenderer(object):
+    # compiled form of Inputs.maps: constant text, per-byte lookup tables
+    # keyed on the button word, and axis lookups; nothing is copied per frame
+    def __init__(self, maps: list[Bk2Map], empty: str, swap: bool):
+        self.blank = ''.join(
+            AXIS_TEXT[0] if map.x_axis or map.y_axis else empty
+            for map in maps)
+        self.parts: list[Callable] = []
+
+        text, masks = '', []
+        for map in maps:
+            button = map.data_mask and map.data_attr
+            if masks and not (button and self.__same_byte(masks, map)):
+                self.__add_table(masks, empty)
+                masks = []
+
+            if button:
+                if text:
+                    self.__add_text(text)
+                    text = ''
+                masks.append((map.data_mask, map.bk2_value))
+
+            elif not map.data_attr:
+                text += AXIS_TEXT[0] if map.x_axis or map.y_axis else empty
+
+            else:
+                if text:
+                    self.__add_text(text)
+                    text = ''
+                self.__add_attr(map.swap_axis(swap), empty)
+
+        if masks:
+            self.__add_table(masks, empty)
+        if text:
+            self.__add_text(text)
+
+    def render(self, data) -> str:
+        if not data:
+            return self.blank
+        return ''.join([part(data) for part in self.parts])
+
+    @staticmethod
+    def __same_byte(masks: list[tuple[int, str]], map: Bk2Map) -> bool:
+        return (masks[0][0] > 0xff) == (map.data_mask > 0xff)
+
+    def __add_text(self, text: str):
+        self.parts.append(lambda data: text)
+
+    def __add_table(self, masks: list[tuple[int, str]], empty: str):
+        shift = 8 if masks[0][0] > 0xff else 0
+        table = [
+            ''.join(value if (byte << shift) & mask else empty
+                    for mask, value in masks)
+            for byte in range(256)
+        ]
+        if shift:
+            self.parts.append(lambda data: table[data.button >> 8])
+        else:
+            self.parts.append(lambda data: table[data.button & 0xff])
+
+    def __add_attr(self, map: Bk2Map, empty: str):
+        get = operator.attrgetter(map.data_attr)
+        if map.x_axis or map.y_axis:
+            self.parts.append(lambda data: AXIS_TEXT[get(data)])
+        else:
+            value = map.bk2_value
+            self.parts.append(lambda data: value if get(data) else empty)
+
+
+@dataclass(frozen=True, slots=True)
 class Inputs:
-    maps: list[Bk2Map]
+    maps: tuple[Bk2Map, ...]
     empty: str = '.'
+    renderers: tuple[InputRenderer, ...] = field(
+        default=(), repr=False, compare=False)
+
+    def compile(self):
+        # a copy holding the renderers, unswapped then swapped
+        if self.renderers:
+            return self
+        return dataclasses.replace(self, renderers=tuple(
+            InputRenderer(self.maps, self.empty, swap)
+            for swap in (False, True)))
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, renderers=(), **changes).compile()
+
+    def renderer(self, swap: bool = False) -> InputRenderer:
+        if not self.renderers:
+            return InputRenderer(self.maps, self.empty, swap)
+        return self.renderers[swap]
 
     def __str__(self, data=None, swap: bool = False):
-        output = ''
-        for map in self.maps:
-            if map.x_axis or map.y_axis:
-                if data and map.data_attr:
-                    swapped = map.swap_axis(swap)
-                    prop = getattr(data, swapped.data_attr)
-                    output += str(prop).rjust(5) + ','
-                else:
-                    output += str(0).rjust(5) + ','
-            else:
-                if data and map.data_attr:
-                    prop = getattr(data, map.data_attr)
-                    output += map.bk2_value if prop else self.empty
-                else:
-                    output += self.empty
-        return output
+        return self.renderer(swap).render(data)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class InputLog:
     power: Inputs
-    keys: list[Inputs]
-    port_swap: list[bool]
+    keys: tuple[Optional[Inputs], ...]
+    port_swap: tuple[bool, ...]
     tag: str = 'Input'
+    port_maps: tuple[tuple[Bk2Map, ...], ...] = field(
+        default=(), repr=False, compare=False)
 
     def footer(self):
         return f"[/{self.tag}]\r\n"
@@ -110,30 +329,51 @@ class InputLog:
     def header(self):
         return f"[{self.tag}]\r\n"
 
-    def log_key(self, players: int = 4):
+    def compile(self):
+        # a copy with per port maps with their axes swapped, and renderers.
+        # render with the compiled copy, the original builds them per call
+        if self.port_maps:
+            return self
+        return dataclasses.replace(
+            self, power=self.power.compile(),
+            keys=tuple(keys and keys.compile() for keys in self.keys),
+            port_maps=tuple(
+                tuple(map.swap_axis(swap) for map in keys.maps)
+                if keys else ()
+                for keys, swap in zip(self.keys, self.port_swap)))
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, port_maps=(), **changes).compile()
+
+    def log_key(self):
+        # one group per plugged port, named after its position so sparse
+        # ports (P1 and P3) keep their numbers
         log_key = 'LogKey:#'
         for map in self.power.maps:
             log_key += f"{map.bk2_key}|"
 
-        for id, keys in zip(range(players), self.keys):
+        port_maps = self.compile().port_maps
+        for id, (keys, maps) in enumerate(zip(self.keys, port_maps)):
+            if keys is None:
+                continue
             log_key += '#'
-            for map in keys.maps:
-                swap = map.swap_axis(self.port_swap[id])
-                log_key += f"P{id+1} {swap.bk2_key}|"
+            for map in maps:
+                log_key += f"P{id+1} {map.bk2_key}|"
         return f"{log_key}\r\n"
 
-    def __str__(self, inputs: list = [], players: int = 4):
-        output = '|'
-        output += f"{str(self.power)}|"
-
-        for id, input in zip(range(players), inputs):
-            keys = self.keys[id]
-            port_swap = self.port_swap[id]
-            output += f"{keys.__str__(input, port_swap)}|"
-        return f"{output}\r\n"
+    def __str__(self, inputs: list = []):
+        # inputs are indexed by port, unplugged ports are skipped
+        output = [f"|{self.power.renderer().blank}"]
+        for id, keys in enumerate(self.keys):
+            if keys is None:
+                continue
+            input = inputs[id] if id < len(inputs) else None
+            output.append(keys.renderer(self.port_swap[id]).render(input))
+        output.append('\r\n')
+        return '|'.join(output)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Subtitle:
     frame: int
     message: str
@@ -154,7 +394,7 @@ class SyncSettings:
     type: str
     ports: list[int]
     set_controllers: Callable[[dict, list[int]], dict]
-    sync_settings: dict
+    sync_settings: Callable[[], dict]     # built when the bk2 is written
 
     def build_settings(self):
         full_type = (
@@ -163,7 +403,7 @@ class SyncSettings:
         )
         settings = {'o': {"$type": full_type}}
         settings = self.set_controllers(settings, self.ports)
-        settings['o'].update(self.sync_settings)
+        settings['o'].update(self.sync_settings())
         return settings
 
     def to_json(self):
@@ -171,6 +411,76 @@ class SyncSettings:
             self.build_settings(), separators=(',', ':')) + "\r\n"
 
 
+class Bk2Stream(object):
+    # a bk2 being written, input log lines are pushed one at a time;
+    # subtitles are only read on close, so they can still be collected
+    def __init__(self, bizhawk, original: str, output: str,
+                 data: io.BytesIO = None):
+        self.bizhawk = bizhawk
+        self.original = original
+        self.output = output
+        self.data = data
+        _, self.ext = os.path.splitext(original)
+        self.input_log = None
+        self.bk2 = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            self.__open()
+        except BaseException:
+            self.abort()
+            raise
+
+    def __open(self):
+        if self.data is None:
+            self.bk2.write(self.original, f"original{self.ext}")
+        self.bk2.writestr('Comments.txt', ''.join(
+            str(comment) for comment in self.bizhawk.comments))
+        self.bk2.writestr('Header.txt', str(self.bizhawk.header))
+
+        info = zipfile.ZipInfo('Input Log.txt', time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o600 << 16
+        entry = self.bk2.open(info, 'w')
+        self.input_log = io.TextIOWrapper(entry, 'utf-8', newline='')
+        log = self.bizhawk.input_log
+        self.input_log.write(log.header())
+        self.input_log.write(log.log_key())
+
+    def write(self, input: str):
+        self.input_log.write(input)
+
+    def close(self):
+        try:
+            self.input_log.write(self.bizhawk.input_log.footer())
+            self.input_log.close()
+            if self.data is not None:
+                self.bk2.writestr(
+                    f"original{self.ext}", self.data.getvalue())
+            self.bk2.writestr('Subtitles.txt', ''.join(
+                str(subtitle) for subtitle in self.bizhawk.subtitles))
+            self.bk2.writestr(
+                'SyncSettings.json', self.bizhawk.sync_settings.to_json())
+            self.bk2.close()
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        # the zip can't be finished properly, only removed. the open entry
+        # goes first, the zip refuses to close while it is being written,
+        # and the file itself is closed whatever happens
+        try:
+            if self.input_log is not None:
+                self.input_log.close()
+            self.bk2.close()
+        except Exception:
+            pass
+        finally:
+            if self.bk2.fp is not None:
+                self.bk2.fp.close()
+        if os.path.exists(self.output):
+            os.remove(self.output)
+
+
 class BizHawk(object):
     # supported cores
     class Core(Enum):
@@ -195,7 +505,7 @@ class BizHawk(object):
                     type=f"{ares_base}.Accuracy.Ares64+Ares64SyncSettings",
                     ports=self.ports,
                     set_controllers=self.__ares_set_controllers,
-                    sync_settings=self.__ares_sync_settings())
+                    sync_settings=self.__ares_sync_settings)
 
             case self.Core.ARES_PERFORMANCE:
                 self.input_log: InputLog = self.__ares_input_log()
@@ -203,7 +513,7 @@ class BizHawk(object):
                     type=f"{ares_base}.Performance.Ares64+Ares64SyncSettings",
                     ports=self.ports,
                     set_controllers=self.__ares_set_controllers,
-                    sync_settings=self.__ares_sync_settings())
+                    sync_settings=self.__ares_sync_settings)
 
             case self.Core.MUPEN64PLUS:
                 self.input_log: InputLog = self.__mupen64plus_input_log()
@@ -211,43 +521,30 @@ class BizHawk(object):
                     type='Nintendo.N64.N64SyncSettings',
                     ports=self.ports,
                     set_controllers=self.__mupen64plus_set_controllers,
-                    sync_settings=self.__mupen64plus_sync_settings())
+                    sync_settings=self.__mupen64plus_sync_settings)
 
             case _:
                 raise ValueError('Supplied core is not supported')
 
-    def build_bk2(self, original: str, inputs: list, output: str):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            _, ext = os.path.splitext(original)
-            shutil.copy(original, f"{tmpdir}/original{ext}")
-
-            with open(f"{tmpdir}/Comments.txt", 'w') as comments:
-                for comment in self.comments:
-                    comments.write(str(comment))
-
-            open(f"{tmpdir}/Header.txt", 'w').write(str(self.header))
-
-            with open(f"{tmpdir}/Input Log.txt", 'w') as input_log:
-                input_log.write(self.input_log.header())
-                input_log.write(self.input_log.log_key(self.players))
-                for input in inputs:
-                    input_log.write(input)
-                input_log.write(self.input_log.footer())
-
-            with open(f"{tmpdir}/Subtitles.txt", 'w') as subtitles:
-                for subtitle in self.subtitles:
-                    subtitles.write(str(subtitle))
-
-            with open(f"{tmpdir}/SyncSettings.json", 'w') as sync_settings:
-                sync_settings.write(self.sync_settings.to_json())
-
-            archive = shutil.make_archive(output, 'zip', tmpdir)
-            name, ext = os.path.splitext(archive)
-            os.rename(archive, name)
-        return name
+        self.input_log = self.input_log.compile()
+
+    def build_bk2(self, original: str, inputs: Iterable[str], output: str,
+                  data: io.BytesIO = None):
+        # inputs can be a generator, lines go straight into the archive.
+        # with data, original is only a name and the recording is taken
+        # from memory once inputs is exhausted (it may still be arriving)
+        stream = Bk2Stream(self, original, output, data)
+        try:
+            for input in inputs:
+                stream.write(input)
+        except BaseException:
+            stream.abort()
+            raise
+        stream.close()
+        return output
 
-    def __n64_mappings(self) -> Tuple[list[Bk2Map], list[bool]]:
-        key_maps = [
+    def __n64_mappings(self) -> Tuple[tuple[Bk2Map, ...], list[bool]]:
+        key_maps = tuple(_interned(map) for map in (
             Bk2Map('Y Axis',  '', y_axis=True),
             Bk2Map('X Axis',  '', x_axis=True),
             Bk2Map('A Up',    ''),
@@ -268,24 +565,24 @@ class BizHawk(object):
             Bk2Map('C Right', 'r'),
             Bk2Map('L',       'l'),
             Bk2Map('R',       'r'),
-        ]
-        port_swaps = [False, True, False, True]
+        ))
+        port_swaps = (False, True, False, True)
         return key_maps, port_swaps
 
-    def __power_mappings(self) -> list[Bk2Map]:
-        return [Bk2Map('Reset', ''), Bk2Map('Power', '')]
+    def __power_mappings(self) -> tuple[Bk2Map, ...]:
+        return (_interned(Bk2Map('Reset', '')), _interned(Bk2Map('Power', '')))
 
     # ares cores
     def __ares_input_log(self) -> InputLog:
         power_maps = self.__power_mappings()
         key_map, port_swaps = self.__n64_mappings()
-        ares_map = list(filter(
+        ares_map = tuple(filter(
             lambda map: not map.bk2_key.startswith('A '), key_map))
 
         port_maps = [None, None, None, None]
         for id, plugged in enumerate(self.ports):
             port_maps[id] = Inputs(ares_map) if plugged else None
-        return InputLog(Inputs(power_maps), port_maps, port_swaps)
+        return InputLog(Inputs(power_maps), tuple(port_maps), port_swaps)
 
     def __ares_set_controllers(self, settings, ports) -> dict:
         for id, port in enumerate(ports):
@@ -305,7 +602,7 @@ class BizHawk(object):
         port_maps = [None, None, None, None]
         for id, plugged in enumerate(self.ports):
             port_maps[id] = Inputs(mupen_map) if plugged else None
-        return InputLog(Inputs(power_maps), port_maps, port_swaps)
+        return InputLog(Inputs(power_maps), tuple(port_maps), port_swaps)
 
     def __mupen64plus_set_controllers(self, settings, ports) -> dict:
         controllers = [None] * 4
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import time
+import zipfile
+from typing import Iterator
+from bizhawk import Bk2Map
+from krec_to_bk2 import data_attr
+from krec_writer import *
+
+
+DEFAULT_APP_NAME = 'bk2_to_krec'
+
+
+class PlayerDecoder(object):
+    # decodes one player's column group of an Input Log line
+    def __init__(self, player: int, keys: list[str], empty: str = '.'):
+        self.player = player
+        self.empty = empty
+        self.axes: list[str] = []
+        self.masks: list[int] = []
+        self.buttons: dict[str, int] = {}
+
+        for key in keys:
+            name = key.split(' ', 1)[1]
+            if name.endswith('Axis'):
+                if self.masks:
+                    raise ValueError(f"axis {key} must come before buttons")
+                axis = name.split(' ')[0]
+                map = Bk2Map(f"{axis} Axis", '', x_axis=axis == 'X',
+                             y_axis=axis == 'Y')
+                self.axes.append(data_attr(map))
+            else:
+                self.masks.append(
+                    OS_CONT_PAD_BUTTONS.get(data_attr(Bk2Map(name, '')), 0))
+
+    def decode(self, text: str) -> tuple[int, int, int]:
+        # (button, stick_x, stick_y)
+        *axes, keys = text.split(',')
+        button = self.buttons.get(keys)
+        if button is None:
+            button = 0
+            for mask, key in zip(self.masks, keys):
+                if key != self.empty:
+                    button |= mask
+            self.buttons[keys] = button
+
+        sticks = {'stick_x': 0, 'stick_y': 0}
+        for attr, value in zip(self.axes, axes):
+            sticks[attr] = int(value)
+        return button, sticks['stick_x'], sticks['stick_y']
+
+
+def convert(bk2_path: str, output: str, app_name: str = DEFAULT_APP_NAME,
+            start_time: int = 0) -> tuple[str, int]:
+    with zipfile.ZipFile(bk2_path, 'r') as bk2:
+        game_name = parse_game_name(bk2)
+        chats = parse_subtitles(bk2)
+
+        entry = bk2.open('Input Log.txt')
+        with io.TextIOWrapper(entry, 'utf-8', newline='') as input_log, \
+                open(output, 'wb') as stream:
+            lines = iter(input_log)
+            for line in lines:
+                if line.startswith('LogKey:'):
+                    players = parse_log_key(line)
+                    break
+            else:
+                raise ValueError(f"{bk2_path} has no LogKey")
+
+            writer = KrecWriter(
+                stream, app_name, game_name, start_time or int(time.time()),
+                1, len(players))
+
+            # subtitle frames are playback event indexes (see krec_to_bk2)
+            chat = 0
+            for pads in parse_inputs(lines, players):
+                while chat < len(chats) and chats[chat][0] <= writer.events:
+                    writer.chat(*chats[chat][1:])
+                    chat += 1
+                writer.values([
+                    pack_get_keys(player.player, *pad)
+                    for player, pad in zip(players, pads)
+                ])
+
+            for _, nickname, message in chats[chat:]:
+                writer.chat(nickname, message)
+    return output, writer.frames
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Converts a Bizhawk TAS (*.bk2) to a Kaillera recording (*.krec)'
+    ))
+
+    parser.add_argument('-b', metavar='BK2', required=True, dest='bk2',
+                        help='Bizhawk movie file (*.bk2)')
+    parser.add_argument('-o', metavar='KREC', required=False, dest='output',
+                        help='output recording (default: BK2.krec)')
+    parser.add_argument('-a', metavar='APP', required=False, dest='app_name',
+                        help='header client name '
+                        f"(default: {DEFAULT_APP_NAME})")
+    parser.add_argument('-t', metavar='TIME', required=False, dest='time',
+                        type=int, help='header start time (default: now)')
+
+    parser.set_defaults(app_name=DEFAULT_APP_NAME, time=0)
+    return parser.parse_args()
+
+
+def parse_game_name(bk2: zipfile.ZipFile) -> str:
+    with io.TextIOWrapper(bk2.open('Header.txt'), 'utf-8') as header:
+        for line in header:
+            key, _, value = line.rstrip('\r\n').partition(' ')
+            if key == 'GameName':
+                return value
+    return ''
+
+
+def parse_inputs(lines: Iterator[str], players: list[PlayerDecoder]):
+    for line in lines:
+        if line.startswith('[/'):
+            break
+        columns = line.rstrip('\r\n').split('|')[2:]
+        yield [player.decode(text) for player, text in zip(players, columns)]
+
+
+def parse_log_key(line: str) -> list[PlayerDecoder]:
+    if not line.startswith('LogKey:'):
+        raise ValueError(f"expected LogKey, got {line[:32]!r}")
+
+    # first group is the console (Reset, Power), then one per plugged
+    # port, whose keys are prefixed with its number (P1 A, P3 A)
+    groups = line.rstrip('\r\n')[len('LogKey:'):].split('#')[2:]
+    players = []
+    for group in groups:
+        keys = [key for key in group.split('|') if key]
+        players.append(PlayerDecoder(int(keys[0].split(' ')[0][1:]), keys))
+    return players
+
+
+def parse_subtitles(bk2: zipfile.ZipFile) -> list[tuple[int, str, str]]:
+    if 'Subtitles.txt' not in bk2.namelist():
+        return []
+
+    chats = []
+    with io.TextIOWrapper(bk2.open('Subtitles.txt'), 'utf-8') as subtitles:
+        for line in subtitles:
+            fields = line.rstrip('\r\n').split(' ', 6)
+            if len(fields) < 7 or fields[0] != 'subtitle':
+                continue
+            nickname, message = '', fields[6]
+            if message.startswith('<') and '> ' in message:
+                nickname, message = message[1:].split('> ', 1)
+            chats.append((int(fields[1]), nickname, message))
+    return sorted(chats, key=lambda chat: chat[0])
+
+
+def main(args):
+    try:
+        output, _ = convert(args.bk2, args.output or f"{args.bk2}.krec",
+                            args.app_name, args.time)
+    except Exception as e:
+        print(e)
+        exit(1)
+    print(output)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
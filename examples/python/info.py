@@ -2,13 +2,16 @@
 
 import argparse
 import datetime
+import io
+import itertools
 import os
 import sys
 import yaml
-from lib.krec import *
+from krec_dispatch import *
+from krec_stream import CACHE_DIR, PlaybackStream, probe_header
 
 
-def get_header(header: Krec.Header):
+def get_header(header):
     start_time = datetime.datetime.fromtimestamp(header.time)
     return {
         'client': header.app_name,
@@ -18,38 +21,110 @@ def get_header(header: Krec.Header):
     }
 
 
-def get_messages(playback: Krec.Playback, start_time: int):
-    messages = []
-    for id, event in enumerate(playback):
-        if event.type == Krec.Playback.Event.chat:
-            user = event.data.nickname
-            time = datetime.datetime.fromtimestamp(start_time + (id/60))
-            timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-            messages.append(f"[{timestamp}] <{user}> {event.data.message}")
-    return messages
+def format_message(id: int, user: str, message: str, start_time: int):
+    time = datetime.datetime.fromtimestamp(start_time + (id/60))
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    return f"[{timestamp}] <{user}> {message}"
 
 
-def get_stats(playback: Krec.Playback):
-    frames = [e for e in playback if e.type == Krec.Playback.Event.values]
-    messages = [e for e in playback if e.type == Krec.Playback.Event.chat]
-    return {
-        'events': len(playback),
-        'frames': len(frames),
-        'seconds': round(len(frames)/60, 2),
-        'messages': len(messages),
-    }
+def get_message(id: int, event, start_time: int):
+    return format_message(
+        id, event.data.nickname, event.data.message, start_time)
+
+
+def get_messages(playback, start_time: int):
+    chats = ChatCollector(lambda id, e: get_message(id, e, start_time))
+    Dispatcher(chats).run(playback)
+    return chats.messages
+
+
+def get_stats(playback):
+    stats = StatsCounter()
+    Dispatcher(stats).run(playback)
+    return stats.stats()
 
 
 def parse_arguments():
     parse = argparse.ArgumentParser()
-    parse.add_argument('file', nargs='+', help='krec recording (*.krec)')
-    return parse.parse_args()
+    parse.add_argument('file', nargs='*', help='krec recording (*.krec)')
+    parse.add_argument('-c', action='store_true', dest='cache',
+                       help='reuse decoded recordings from a cache')
+    parse.add_argument('-C', metavar='DIR', dest='cache_dir',
+                       help='cache directory, implies -c '
+                       f"(default: {CACHE_DIR})")
+    parse.add_argument('-H', action='store_true', dest='header_only',
+                       help='only read the header, skip stats and messages')
+    parse.add_argument('-R', action='store_true', dest='recover',
+                       help='salvage the readable events of damaged '
+                       'recordings instead of skipping them')
+    parse.add_argument('-i', action='store_true', dest='stdin',
+                       help='also read recordings from stdin, one path per '
+                       'line, and keep running until it is closed')
+    args = parse.parse_args()
+    if args.cache_dir:
+        args.cache = True
+    if not args.file and not args.stdin:
+        parse.error('no recordings given')
+    return args
+
+
+def read_cached(cache, file: str):
+    cached = cache.get(file)
+    messages = [
+        format_message(id, user, message, cached.header.time)
+        for id, user, message in cached.chats
+    ]
+    return cached.header, cached.stats(), messages
+
+
+def read_playback(file: str):
+    # the generated parser is only imported for the first recording read
+    from lib.krec import Krec
+
+    with PlaybackStream.from_file(Krec, file) as playback:
+        return read_events(playback)
+
+
+def read_recovered(file: str):
+    # damaged records are left out instead of ending the read
+    from krec_recover import recover_file
+    from lib.krec import Krec
+
+    data, report = recover_file(file)
+    with PlaybackStream(Krec, io.BytesIO(data)) as playback:
+        return *read_events(playback), report
+
+
+def read_events(playback: PlaybackStream):
+    # one pass over playback for both stats and messages
+    start_time = playback.header.time
+    stats = StatsCounter()
+    chats = ChatCollector(lambda id, e: get_message(id, e, start_time))
+    Dispatcher(stats, chats).run(playback)
+    return playback.header, stats.stats(), chats.messages
 
 
 def main(args):
-    for file in args.file:
+    cache = None
+    if args.cache:
+        from krec_cache import RecordingCache
+        cache = RecordingCache(args.cache_dir or CACHE_DIR)
+
+    files = args.file
+    if args.stdin:
+        files = itertools.chain(files, (
+            line.strip() for line in sys.stdin if line.strip()))
+    for file in files:
+        damage = None
         try:
-            krec = Krec.from_file(file)
+            if args.header_only:
+                header = probe_header(file)
+            elif args.recover:
+                header, stats, messages, damage = read_recovered(file)
+            elif cache:
+                header, stats, messages = read_cached(cache, file)
+            else:
+                header, stats, messages = read_playback(file)
         except BaseException as e:
             print(f"Unable to open {file}: {e}")
             continue
@@ -57,14 +132,17 @@ def main(args):
         info = {
             'krec': {
                 'name': os.path.basename(file),
-                'header': get_header(krec.header),
-                'stats': get_stats(krec.playback),
-                'messages': get_messages(krec.playback, krec.header.time)
+                'header': get_header(header),
             }
         }
+        if not args.header_only:
+            info['krec']['stats'] = stats
+            info['krec']['messages'] = messages
+        if damage and damage.damage:
+            info['krec']['damage'] = damage.to_dict()
 
         yaml.dump(info, sys.stdout, sort_keys=False)
-        print()
+        print(flush=True)
 
 
 if __name__ == "__main__":
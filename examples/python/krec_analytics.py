@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import yaml
+import numpy as np
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+from krec_catalog import find_recordings
+from krec_frames import BUTTONS, decode_ports
+from krec_ports import PLAYERS
+from krec_stream import *
+
+FRAMES_PER_MINUTE = 60 * 60
+STICK_BINS = 16                     # per axis, 16 values each
+APM_BUCKET = 25                     # actions per minute per histogram bin
+APM_BUCKETS = 40                    # the last one takes everything above
+CHUNK_FILES = 32                    # recordings per worker task
+
+# button columns counted as actions, reserved bits never are
+ACTION_BUTTONS = np.array(
+    [not name.startswith('reserved') for name in BUTTONS])
+
+
+def _zeros(*shape) -> np.ndarray:
+    return np.zeros(shape, dtype=np.int64)
+
+
+def _add(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # sum of two counts of possibly different lengths
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+@dataclass
+class PlayerStats:
+    frames: int = 0                 # frames with a controller answering
+    presses: np.ndarray = field(default_factory=lambda: _zeros(16))
+    stick: np.ndarray = field(
+        default_factory=lambda: _zeros(STICK_BINS, STICK_BINS))
+    apm: np.ndarray = field(default_factory=lambda: _zeros(APM_BUCKETS))
+
+    def merge(self, other):
+        self.frames += other.frames
+        self.presses += other.presses
+        self.stick += other.stick
+        self.apm += other.apm
+
+    @property
+    def actions(self) -> int:
+        return int(self.presses[ACTION_BUTTONS].sum())
+
+    def actions_per_minute(self) -> float:
+        if not self.frames:
+            return 0.0
+        return self.actions * FRAMES_PER_MINUTE / self.frames
+
+
+@dataclass
+class Aggregate:
+    # partial result of any number of recordings of one game, merge() adds
+    # two of them so workers can each reduce their own share
+    recordings: int = 0
+    frames: int = 0
+    players: dict[int, PlayerStats] = field(default_factory=dict)
+    chats: np.ndarray = field(default_factory=lambda: _zeros(0))
+    talkers: Counter = field(default_factory=Counter)
+
+    def player(self, player_id: int) -> PlayerStats:
+        stats = self.players.get(player_id)
+        if stats is None:
+            stats = self.players[player_id] = PlayerStats()
+        return stats
+
+    def merge(self, other):
+        self.recordings += other.recordings
+        self.frames += other.frames
+        for player_id, stats in other.players.items():
+            self.player(player_id).merge(stats)
+        self.chats = _add(self.chats, other.chats)
+        self.talkers.update(other.talkers)
+
+    def summary(self, top: int = 10) -> dict:
+        players = {}
+        for player_id in sorted(self.players):
+            stats = self.players[player_id]
+            minutes = stats.frames / FRAMES_PER_MINUTE
+            buttons = {
+                name: round(int(count) / minutes, 2) if minutes else 0.0
+                for name, count, action in zip(
+                    BUTTONS, stats.presses, ACTION_BUTTONS) if action
+            }
+            players[f"P{player_id}"] = {
+                'minutes': round(minutes, 2),
+                'actions': stats.actions,
+                'apm': round(stats.actions_per_minute(), 2),
+                'apm histogram': {
+                    f"{bucket * APM_BUCKET}+": int(count)
+                    for bucket, count in enumerate(stats.apm) if count
+                },
+                'presses per minute': dict(sorted(
+                    buttons.items(), key=lambda item: -item[1])),
+                'stick heatmap': stick_heatmap(stats.stick),
+            }
+        return {
+            'recordings': self.recordings,
+            'hours': round(self.frames / FRAMES_PER_MINUTE / 60, 2),
+            'players': players,
+            'messages': int(self.chats.sum()),
+            'messages per minute of play': [int(n) for n in self.chats],
+            'top talkers': dict(self.talkers.most_common(top)),
+        }
+
+
+def stick_heatmap(stick: np.ndarray) -> list[str]:
+    # rows from stick_y +127 down to -128, columns stick_x -128 to +127,
+    # shaded by the share of frames in each cell
+    shades = ' .:-=+*#%@'
+    peak = stick.max()
+    if not peak:
+        return []
+    rows = []
+    for row in stick.T[::-1]:
+        rows.append(''.join(
+            shades[int(count * (len(shades) - 1) / peak)] for count in row))
+    return rows
+
+
+def player_stats(rows: np.ndarray) -> PlayerStats:
+    # rows of one player, frame ordered; the last port of a frame wins,
+    # like parse_inputs
+    rows = rows[rows['has_pad']]
+    if not len(rows):
+        return PlayerStats()
+    last = np.append(rows['frame'][1:] != rows['frame'][:-1], True)
+    rows = rows[last]
+
+    raw = np.ascontiguousarray(rows['button'], dtype='>u2').view(np.uint8)
+    held = np.unpackbits(raw.reshape(-1, 2), axis=1).astype(bool)
+    # a press is a button going down, frames without a pad don't release
+    pressed = held.copy()
+    pressed[1:] &= ~held[:-1]
+
+    stats = PlayerStats(len(rows))
+    stats.presses += pressed.sum(axis=0)
+    edges = np.arange(-128, 129, 256 // STICK_BINS)
+    stick, _, _ = np.histogram2d(
+        rows['stick_x'], rows['stick_y'], bins=(edges, edges))
+    stats.stick += stick.astype(np.int64)
+
+    bucket = min(int(stats.actions_per_minute() // APM_BUCKET),
+                 APM_BUCKETS - 1)
+    stats.apm[bucket] += 1
+    return stats
+
+
+def analyze_bytes(data: bytes) -> tuple[RecordingHeader, Aggregate]:
+    # a single scan of the records: values decode to port columns, chats
+    # are counted by the minute they were sent in
+    header = RecordingHeader.parse(read_header(BytesIO(data)))
+    chats, talkers = [], Counter()
+
+    def other(offset: int, length: int, frame: int):
+        if data[offset] == Event.CHAT:
+            nickname = data[offset+1:data.index(b'\0', offset + 1)]
+            talkers[nickname.decode('utf-8', 'replace')] += 1
+            chats.append(frame // FRAMES_PER_MINUTE)
+
+    ports = decode_ports(data, header.player_count, other)
+    frames = int(ports['frame'][-1]) + 1 if len(ports) else 0
+    aggregate = Aggregate(1, frames, talkers=talkers)
+    aggregate.chats = np.bincount(np.array(chats, dtype=np.int64))
+    for player_id in range(1, PLAYERS + 1):
+        rows = ports[ports['player_id'] == player_id]
+        if len(rows):
+            aggregate.players[player_id] = player_stats(rows)
+    return header, aggregate
+
+
+def analyze_files(paths: list[str]) -> tuple[dict[str, Aggregate],
+                                             list[str]]:
+    # one worker task: aggregates per game name and the failures
+    games, failed = {}, []
+    for path in paths:
+        try:
+            with open(path, 'rb') as stream:
+                header, aggregate = analyze_bytes(stream.read())
+        except Exception as e:
+            failed.append(f"{path}: {e}")
+            continue
+        games.setdefault(header.game_name, Aggregate()).merge(aggregate)
+    return games, failed
+
+
+def analyze_all(paths: list[str], jobs: int) -> tuple[dict[str, Aggregate],
+                                                      list[str]]:
+    chunks = [paths[start:start+CHUNK_FILES]
+              for start in range(0, len(paths), CHUNK_FILES)]
+    games, failed = {}, []
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        # workers send back one partial aggregate per chunk, not per file
+        if jobs > 1 and len(chunks) > 1:
+            results = executor.map(analyze_files, chunks)
+        else:
+            results = map(analyze_files, chunks)
+
+        for partial, errors in results:
+            for game, aggregate in partial.items():
+                games.setdefault(game, Aggregate()).merge(aggregate)
+            failed += errors
+    return games, failed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Computes input and chat statistics over Kaillera recordings '
+        '(*.krec), per game'
+    ))
+    parser.add_argument('path', nargs='+',
+                        help='krec recordings or directories to search')
+    parser.add_argument('-j', metavar='JOBS', type=int, dest='jobs',
+                        help='worker processes (default: cpu count)')
+    parser.add_argument('-t', metavar='TOP', type=int, dest='top',
+                        help='chat nicknames to list (default: 10)')
+
+    parser.set_defaults(jobs=os.cpu_count(), top=10)
+    return parser.parse_args()
+
+
+def main(args):
+    paths = []
+    for path in args.path:
+        if os.path.isdir(path):
+            paths.extend(find_recordings(path))
+        else:
+            paths.append(path)
+
+    games, failed = analyze_all(paths, args.jobs)
+    info = {
+        'games': {
+            game: aggregate.summary(args.top)
+            for game, aggregate in sorted(games.items())
+        },
+    }
+    if failed:
+        info['failed'] = failed
+    yaml.dump(info, sys.stdout, sort_keys=False, allow_unicode=True,
+              width=200)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
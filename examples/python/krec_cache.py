@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterator, Optional
+from krec_mmap import MappedRecording
+from krec_stream import *
+
+
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# entry: header (plugged ports as a bit mask), krec header, then one
+# array per column
+ENTRY_FORMAT = '<4sHHIIII'
+ENTRY_MAGIC = b'KCCH'
+ENTRY_VERSION = 2
+ENTRY_EXTENSION = '.kcc'
+
+STRUCTS = ('krec', 'krec_pj64k')
+
+# port columns decoded for krec_pj64k, see MappedRecording.ports. they
+# feed krec_to_bk2 -c through CachedRecording.pads
+PORT_COLUMNS = (
+    ('frame', 'I'), ('player_id', 'b'), ('type', 'b'),
+    ('button', 'H'), ('stick_x', 'b'), ('stick_y', 'b'),
+)
+
+
+def _split_strz(raw: bytes, count: int) -> list[str]:
+    return [
+        text.decode('utf-8', 'replace')
+        for text in raw.split(b'\0', count)[:count]
+    ]
+
+
+@dataclass
+class CachedRecording:
+    header: RecordingHeader
+    types: array = field(default_factory=lambda: array('B'))
+    chats: list[tuple[int, str, str]] = field(default_factory=list)
+    drops: list[tuple[int, str, int]] = field(default_factory=list)
+    ports: dict[str, array] = field(default_factory=lambda: {
+        name: array(typecode) for name, typecode in PORT_COLUMNS})
+    plugged: list[bool] = field(default_factory=lambda: [False] * PORTS)
+
+    @classmethod
+    def decode(cls, path: str, ksy: str):
+        with MappedRecording(path) as recording:
+            cached = cls(recording.header)
+            for index, (offset, length) in enumerate(recording.records()):
+                event = recording.map[offset]
+                cached.types.append(event)
+                if event == Event.CHAT:
+                    raw = recording.map[offset+1:offset+length]
+                    cached.chats.append((index, *_split_strz(raw, 2)))
+                elif event == Event.DROP:
+                    raw = recording.map[offset+1:offset+length]
+                    nickname, = _split_strz(raw, 1)
+                    player_id, = struct.unpack_from(
+                        '<i', raw, raw.index(b'\0') + 1)
+                    cached.drops.append((index, nickname, player_id))
+
+            if ksy == 'krec_pj64k':
+                cached.plugged = scan_ports(recording.map,
+                                            recording.player_count)
+                columns = [cached.ports[name] for name, _ in PORT_COLUMNS]
+                for port in recording.ports():
+                    for column, value in zip(columns, port):
+                        column.append(value)
+        return cached
+
+    @classmethod
+    def load(cls, path: str, header_only: bool = False):
+        with open(path, 'rb') as stream:
+            magic, version, plugged, events, chats, drops, ports = \
+                struct.unpack(
+                    ENTRY_FORMAT, stream.read(struct.calcsize(ENTRY_FORMAT)))
+            if magic != ENTRY_MAGIC or version != ENTRY_VERSION:
+                raise ValueError(f"{path} is not a version "
+                                 f"{ENTRY_VERSION} cache entry")
+
+            cached = cls(RecordingHeader.parse(stream.read(HEADER_SIZE)))
+            cached.plugged = [bool(plugged >> id & 1) for id in range(PORTS)]
+            if header_only:
+                return cached
+
+            cached.types = read_array(stream, 'B', events)
+            indexes = read_array(stream, 'I', chats + drops)
+            players = read_array(stream, 'i', drops)
+            size, = struct.unpack('<I', stream.read(4))
+            texts = _split_strz(stream.read(size), chats * 2 + drops)
+
+            cached.chats = [
+                (indexes[id], texts[id * 2], texts[id * 2 + 1])
+                for id in range(chats)
+            ]
+            cached.drops = [
+                (indexes[chats + id], texts[chats * 2 + id], players[id])
+                for id in range(drops)
+            ]
+            cached.ports = {
+                name: read_array(stream, typecode, ports)
+                for name, typecode in PORT_COLUMNS
+            }
+        return cached
+
+    def save(self, stream: BinaryIO):
+        texts = [text for _, *chat in self.chats for text in chat]
+        texts += [nickname for _, nickname, _ in self.drops]
+        blob = b'\0'.join(text.encode('utf-8') for text in texts) + b'\0'
+
+        plugged = sum(1 << id for id, on in enumerate(self.plugged) if on)
+        stream.write(struct.pack(
+            ENTRY_FORMAT, ENTRY_MAGIC, ENTRY_VERSION, plugged,
+            len(self.types), len(self.chats), len(self.drops),
+            len(self.ports['frame'])))
+        stream.write(struct.pack(
+            HEADER_FORMAT, MAGIC, self.header.app_name.encode('utf-8'),
+            self.header.game_name.encode('utf-8'), self.header.time,
+            self.header.player_id, self.header.player_count))
+        write_array(stream, self.types)
+        write_array(stream, array(
+            'I', [chat[0] for chat in self.chats] +
+            [drop[0] for drop in self.drops]))
+        write_array(stream, array('i', [drop[2] for drop in self.drops]))
+        stream.write(struct.pack('<I', len(blob)))
+        stream.write(blob)
+        for name, _ in PORT_COLUMNS:
+            write_array(stream, self.ports[name])
+
+    def stats(self) -> dict:
+        frames = self.types.count(Event.VALUES)
+        return {
+            'events': len(self.types),
+            'frames': frames,
+            'seconds': round(frames/60, 2),
+            'messages': len(self.chats),
+        }
+
+    def pads(self, players: int = PORTS) -> Iterator[list[Optional[Pad]]]:
+        # per values event: os_cont_pad of each player_id, like read_pads
+        ports = self.ports
+        rows = len(ports['frame'])
+        row = 0
+        for frame in range(self.types.count(Event.VALUES)):
+            data = [None] * players
+            while row < rows and ports['frame'][row] == frame:
+                player_id = ports['player_id'][row]
+                if 0 < player_id <= players:
+                    data[player_id-1] = Pad(ports['button'][row],
+                                            ports['stick_x'][row],
+                                            ports['stick_y'][row])
+                row += 1
+            yield data
+
+
+class RecordingCache(object):
+    # decoded recordings keyed by content hash and struct, evicted by LRU
+    def __init__(self, path: str = CACHE_DIR,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite3'))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, size INTEGER, last_used REAL);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+                sha1 TEXT);
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def key(self, path: str, ksy: str) -> str:
+        # content hash, reused while the file's size and mtime are unchanged
+        if ksy not in STRUCTS:
+            raise ValueError(f"unknown struct {ksy}")
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute(
+            'SELECT sha1 FROM files WHERE path = ? AND size = ? AND mtime = ?',
+            (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return f"{ksy}-{row[0]}"
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as stream:
+            while chunk := stream.read(CHUNK_SIZE * 16):
+                sha1.update(chunk)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, sha1.hexdigest()))
+        return f"{ksy}-{sha1.hexdigest()}"
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}{ENTRY_EXTENSION}")
+
+    def probe(self, path: str,
+              ksy: str = 'krec') -> Optional[RecordingHeader]:
+        # header of a cached recording without loading its columns
+        key = self.key(path, ksy)
+        try:
+            return CachedRecording.load(self.entry_path(key), True).header
+        except (OSError, EOFError, ValueError, struct.error):
+            return None
+
+    def get(self, path: str, ksy: str = 'krec') -> CachedRecording:
+        key = self.key(path, ksy)
+        try:
+            cached = CachedRecording.load(self.entry_path(key))
+        except (OSError, EOFError, ValueError, struct.error):
+            cached = CachedRecording.decode(path, ksy)
+            self.put(key, cached)
+            return cached
+
+        with self.db:
+            self.db.execute('UPDATE entries SET last_used = ? WHERE key = ?',
+                            (time.time(), key))
+        return cached
+
+    def put(self, key: str, cached: CachedRecording):
+        # written aside and renamed, a failed write leaves no entry behind
+        stream = tempfile.NamedTemporaryFile('wb', dir=self.path,
+                                             suffix='.tmp', delete=False)
+        try:
+            with stream:
+                cached.save(stream)
+            os.replace(stream.name, self.entry_path(key))
+        finally:
+            if os.path.exists(stream.name):
+                os.remove(stream.name)
+
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                (key, os.path.getsize(self.entry_path(key)), time.time()))
+        self.evict()
+
+    def evict(self):
+        total, = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if total <= self.max_bytes:
+            return
+
+        entries = self.db.execute(
+            'SELECT key, size FROM entries ORDER BY last_used').fetchall()
+        with self.db:
+            for key, size in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self.entry_path(key))
+                except FileNotFoundError:
+                    pass
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import datetime
+import fnmatch
+import os
+import sys
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+from krec_stream import RecordingHeader, probe_header
+
+
+def find_recordings(root: str, pattern: str = '*.krec',
+                    recursive: bool = True) -> Iterator[str]:
+    # scandir reuses the directory listing, no stat per file
+    directories = [root]
+    while directories:
+        try:
+            entries = sorted(os.scandir(directories.pop()),
+                             key=lambda entry: entry.name, reverse=True)
+        except OSError as e:
+            print(f"Unable to list {e.filename}: {e.strerror}",
+                  file=sys.stderr)
+            continue
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    directories.append(entry.path)
+            elif fnmatch.fnmatch(entry.name.lower(), pattern):
+                yield entry.path
+
+
+def probe(path: str) -> tuple[str, Optional[RecordingHeader], str]:
+    try:
+        return path, probe_header(path), ''
+    except (OSError, EOFError, ValueError) as e:
+        return path, None, str(e)
+
+
+def probe_all(paths: Iterator[str], jobs: int):
+    # header reads are tiny, threads hide the per-file open latency
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(probe, paths)
+
+
+def start_time(header: RecordingHeader) -> str:
+    return str(datetime.datetime.fromtimestamp(header.time))
+
+
+def summarize(results) -> dict:
+    games, failed = {}, []
+    for path, header, error in results:
+        if not header:
+            failed.append(f"{path}: {error}")
+            continue
+
+        game = games.setdefault(header.game_name, {})
+        client = game.setdefault(header.app_name, {
+            'recordings': 0, 'first': header.time, 'last': header.time})
+        client['recordings'] += 1
+        client['first'] = min(client['first'], header.time)
+        client['last'] = max(client['last'], header.time)
+
+    for game in games.values():
+        for client in game.values():
+            for key in ('first', 'last'):
+                client[key] = str(
+                    datetime.datetime.fromtimestamp(client[key]))
+    return {'games': games, 'failed': failed}
+
+
+def write_csv(results, output):
+    writer = csv.writer(output)
+    writer.writerow(('path', 'game name', 'client', 'start time',
+                     'player id', 'player count', 'error'))
+    for path, header, error in results:
+        if header:
+            writer.writerow((
+                path, header.game_name, header.app_name, start_time(header),
+                header.player_id, header.player_count, ''))
+        else:
+            writer.writerow((path, '', '', '', '', '', error))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Catalogues Kaillera recordings by game, client and start time '
+        'from their headers only'
+    ))
+
+    parser.add_argument('dir', nargs='+', help='directory of recordings')
+    parser.add_argument('-p', metavar='PATTERN', dest='pattern',
+                        help='file name pattern (default: *.krec)')
+    parser.add_argument('-n', action='store_false', dest='recursive',
+                        help='do not descend into subdirectories')
+    parser.add_argument('-c', action='store_true', dest='csv',
+                        help='list every recording as CSV instead of a '
+                        'summary')
+    parser.add_argument('-j', metavar='JOBS', type=int, dest='jobs',
+                        help='reader threads (default: 16)')
+
+    parser.set_defaults(pattern='*.krec', jobs=16)
+    return parser.parse_args()
+
+
+def main(args):
+    paths = (path for root in args.dir
+             for path in find_recordings(root, args.pattern.lower(),
+                                         args.recursive))
+    results = probe_all(paths, args.jobs)
+
+    if args.csv:
+        write_csv(results, sys.stdout)
+    else:
+        yaml.dump(summarize(results), sys.stdout, sort_keys=False,
+                  allow_unicode=True)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+from bizhawk import BizHawk
+from krec_index import KrecIndex, load_index
+from krec_stream import *
+
+
+# header.time, seconds since the epoch
+HEADER_TIME = 4 + 128 + 128
+
+
+def frame_boundary(data, index: KrecIndex, frame: int) -> int:
+    # offset just past the values event of frame - 1, chats and drops that
+    # follow it belong to frame
+    if frame == 0:
+        return HEADER_SIZE
+    offset, skip = index.locate(frame - 1)
+    for offset, length in scan_records(data, offset):
+        if data[offset] == Event.VALUES:
+            if not skip:
+                return offset + length
+            skip -= 1
+
+
+def clip_chats(data, index: KrecIndex, start: int, begin: int,
+               end: int) -> list[tuple[int, str, str]]:
+    # (event index in the clip, nickname, message) of chats in the clip,
+    # the base the bk2 subtitles and info.py use: the values events before
+    # the chat plus the other events of the clip before it
+    chats = []
+    first = bisect.bisect_left(index.event_offsets, begin)
+    for offset, frame in index.events(Event.CHAT, begin, end):
+        length = record_length(data, offset)
+        nickname, message, _ = \
+            bytes(data[offset+1:offset+length]).split(b'\0')
+        others = bisect.bisect_left(index.event_offsets, offset, first) - first
+        chats.append((frame - start + others,
+                      nickname.decode('utf-8', 'replace'),
+                      message.decode('utf-8', 'replace')))
+    return chats
+
+
+def slice_recording(path: str, output: str, start: int, end: int,
+                    index: KrecIndex = None) -> list[tuple[int, str, str]]:
+    # copies frames start..end - 1 as raw records, only the records around
+    # the two checkpoints are looked at
+    index = index or load_index(path)
+    if not 0 <= start < end <= index.frames:
+        raise IndexError(f"frames {start}..{end} not in 0..{index.frames}")
+
+    with open(path, 'rb') as stream:
+        header = bytearray(read_header(stream))
+        data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        begin = frame_boundary(data, index, start)
+        end_offset = frame_boundary(data, index, end)
+        chats = clip_chats(data, index, start, begin, end_offset)
+
+        # the clip starts start / 60 seconds into the session
+        time, = struct.unpack_from('<i', header, HEADER_TIME)
+        struct.pack_into('<i', header, HEADER_TIME, time + start // 60)
+
+        try:
+            with open(output, 'wb') as clip:
+                clip.write(header)
+                for pos in range(begin, end_offset, CHUNK_SIZE):
+                    clip.write(data[pos:min(pos + CHUNK_SIZE, end_offset)])
+        except BaseException:
+            if os.path.exists(output):
+                os.remove(output)
+            raise
+    return chats
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Extracts a range of frames from a Kaillera recording (*.krec)'
+    ))
+
+    parser.add_argument('file', help='krec recording (*.krec)')
+    parser.add_argument('-s', metavar='START', type=int, dest='start',
+                        required=True, help='first frame of the clip')
+    parser.add_argument('-e', metavar='END', type=int, dest='end',
+                        required=True, help='frame after the last one')
+    parser.add_argument('-o', metavar='OUTPUT', dest='output',
+                        help='clip to write (default: FILE_START-END.krec)')
+    parser.add_argument('-r', metavar='ROM', dest='rom',
+                        help='also convert the clip to a Bizhawk TAS (*.bk2)')
+    parser.add_argument('-v', metavar='VERSION', dest='ver',
+                        help='BizHawk emulator version, with -r '
+                        '(default: 2.8)')
+
+    cores = parser.add_argument_group('cores')
+    core = cores.add_mutually_exclusive_group()
+    for value in [c.value for c in BizHawk.Core]:
+        core.add_argument(
+            value[0], dest='core', action='store_const',
+            help=f"Use {value[1]} Core with -r", const=BizHawk.Core(value))
+
+    parser.set_defaults(ver=2.8, core=BizHawk.Core.MUPEN64PLUS)
+    return parser.parse_args()
+
+
+def main(args):
+    base, ext = os.path.splitext(args.file)
+    output = args.output or f"{base}_{args.start}-{args.end}{ext}"
+    try:
+        chats = slice_recording(args.file, output, args.start, args.end)
+        if args.rom:
+            import krec_to_bk2
+            bk2, _ = krec_to_bk2.convert(output, args.rom, args.ver,
+                                         args.core)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    print(f"{output}: {args.end - args.start} frames")
+    for index, nickname, message in chats:
+        print(f"  {index}: <{nickname}> {message}")
+    if args.rom:
+        print(bk2)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
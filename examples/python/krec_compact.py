@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import BinaryIO, Iterator
+from krec_stream import *
+
+
+# archive: header, the krec header, then zlib blocks of BLOCK_FRAMES values
+# events. a block holds the values sizes, chat / drop records by position,
+# and per player runs of identical ports, each run xor'd with the previous
+ARCHIVE_FORMAT = '<4sHHI'
+ARCHIVE_MAGIC = b'KRCZ'
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = '.krcz'
+BLOCK_FORMAT = struct.Struct('<II')         # compressed size, raw size
+BLOCK_HEADER = struct.Struct('<III')        # frames, side records, players
+SIDE_RECORD = struct.Struct('<II')          # position, length
+PLAYER_COLUMN = struct.Struct('<II')        # runs, delta bytes
+VALUES_HEADER = struct.Struct('<bh')
+DEFAULT_BLOCK_FRAMES = 4096
+IRREGULAR = -1      # values size that does not split into player_count ports
+
+
+def _to_bytes(data: array) -> bytes:
+    if sys.byteorder != 'little':
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_bytes(typecode: str, raw) -> array:
+    data = array(typecode)
+    data.frombytes(raw)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') ^
+            int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class BlockEncoder(object):
+    def __init__(self, player_count: int):
+        self.player_count = max(player_count, 0)
+        self.reset()
+
+    def reset(self):
+        self.sizes = array('h')
+        self.side: list[tuple[int, bytes]] = []
+        self.runs = [array('I') for _ in range(self.player_count)]
+        self.deltas = [bytearray() for _ in range(self.player_count)]
+        self.last = [b''] * self.player_count
+
+    @property
+    def frames(self) -> int:
+        return len(self.sizes)
+
+    def add(self, raw: bytes):
+        if raw[0] != Event.VALUES:
+            self.side.append((self.frames, raw))
+            return
+
+        size = len(raw) - VALUES_HEADER.size
+        if not self.player_count or size % self.player_count:
+            self.side.append((self.frames, raw))
+            self.sizes.append(IRREGULAR)
+            return
+
+        self.sizes.append(size)
+        width = size // self.player_count
+        for player in range(self.player_count):
+            start = VALUES_HEADER.size + player * width
+            port = raw[start:start+width]
+            last = self.last[player]
+            runs = self.runs[player]
+            if runs and port == last:
+                runs[-1] += 1
+                continue
+            runs.append(1)
+            self.deltas[player] += \
+                _xor(port, last) if len(port) == len(last) else port
+            self.last[player] = port
+
+    def encode(self) -> bytes:
+        parts = [
+            BLOCK_HEADER.pack(self.frames, len(self.side), self.player_count),
+            _to_bytes(self.sizes),
+        ]
+        for position, raw in self.side:
+            parts.append(SIDE_RECORD.pack(position, len(raw)))
+            parts.append(raw)
+        for runs, deltas in zip(self.runs, self.deltas):
+            parts.append(PLAYER_COLUMN.pack(len(runs), len(deltas)))
+            parts.append(_to_bytes(runs))
+            parts.append(bytes(deltas))
+        return b''.join(parts)
+
+
+def decode_block(raw: bytes) -> Iterator[bytes]:
+    view = memoryview(raw)
+    frames, side_count, players = BLOCK_HEADER.unpack_from(view)
+    pos = BLOCK_HEADER.size
+    sizes = _from_bytes('h', view[pos:pos+frames*2])
+    pos += frames * 2
+
+    side = []
+    for _ in range(side_count):
+        position, length = SIDE_RECORD.unpack_from(view, pos)
+        pos += SIDE_RECORD.size
+        side.append((position, bytes(view[pos:pos+length])))
+        pos += length
+
+    # widths of the regular values events, in order
+    widths = [size // players for size in sizes if size != IRREGULAR] \
+        if players else []
+    columns = []
+    for _ in range(players):
+        count, length = PLAYER_COLUMN.unpack_from(view, pos)
+        pos += PLAYER_COLUMN.size
+        runs = _from_bytes('I', view[pos:pos+count*4])
+        pos += count * 4
+        deltas = view[pos:pos+length]
+        pos += length
+
+        ports, last, start, frame = [], b'', 0, 0
+        for run in runs:
+            width = widths[frame]
+            delta = bytes(deltas[start:start+width])
+            start += width
+            last = _xor(delta, last) if len(last) == width else delta
+            ports.extend([last] * run)
+            frame += run
+        columns.append(ports)
+
+    side.append((frames + 1, b''))
+    next_side = 0
+    regular = 0
+    for frame, size in enumerate(sizes):
+        while side[next_side][0] == frame:
+            yield side[next_side][1]
+            next_side += 1
+        if size != IRREGULAR:
+            yield VALUES_HEADER.pack(Event.VALUES, size) + b''.join(
+                [ports[regular] for ports in columns])
+            regular += 1
+    for position, raw in side[next_side:-1]:
+        yield raw
+
+
+def encode(krec_path: str, output: BinaryIO,
+           block_frames: int = DEFAULT_BLOCK_FRAMES) -> int:
+    with open(krec_path, 'rb') as stream:
+        header = read_header(stream)
+        data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with data:
+        encoder = BlockEncoder(RecordingHeader.parse(header).player_count)
+        output.write(struct.pack(
+            ARCHIVE_FORMAT, ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, block_frames))
+        output.write(header)
+
+        for offset, length in scan_records(data):
+            if encoder.frames == block_frames:
+                write_block(output, encoder.encode())
+                encoder.reset()
+            encoder.add(data[offset:offset+length])
+        if encoder.frames or encoder.side:
+            write_block(output, encoder.encode())
+    return output.tell()
+
+
+def write_block(output: BinaryIO, raw: bytes):
+    compressed = zlib.compress(raw)
+    output.write(BLOCK_FORMAT.pack(len(compressed), len(raw)))
+    output.write(compressed)
+
+
+def read_archive_header(stream: BinaryIO) -> bytes:
+    # returns the krec header
+    raw = read_exact(stream, struct.calcsize(ARCHIVE_FORMAT))
+    if len(raw) < struct.calcsize(ARCHIVE_FORMAT):
+        raise EOFError('not a complete compact recording')
+    magic, version, _, _ = struct.unpack(ARCHIVE_FORMAT, raw)
+    if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+        raise ValueError(
+            f"not a version {ARCHIVE_VERSION} compact recording")
+    return read_header(stream)
+
+
+def iter_raw_records(stream: BinaryIO) -> Iterator[bytes]:
+    # stream positioned after the headers, one block in memory at a time
+    while raw := read_exact(stream, BLOCK_FORMAT.size):
+        if len(raw) < BLOCK_FORMAT.size:
+            raise EOFError('truncated block header')
+        compressed, size = BLOCK_FORMAT.unpack(raw)
+        block = zlib.decompress(read_exact(stream, compressed))
+        if len(block) != size:
+            raise EOFError(f"block is {len(block)} of {size} bytes")
+        yield from decode_block(block)
+
+
+def decode(path: str, output: BinaryIO) -> int:
+    with open(path, 'rb') as stream:
+        output.write(read_archive_header(stream))
+        for raw in iter_raw_records(stream):
+            output.write(raw)
+    return output.tell()
+
+
+class CompactPlayback(PlaybackStream):
+    # Playback events of a compact recording, record offsets are the ones
+    # the original krec had
+    def __init__(self, krec, stream: BinaryIO):
+        super().__init__(krec, io.BytesIO(read_archive_header(stream)))
+        self.stream = stream
+
+    def records(self) -> Iterator[Record]:
+        offset = HEADER_SIZE
+        for raw in iter_raw_records(self.stream):
+            yield Record(offset, Event(raw[0]), raw)
+            offset += len(raw)
+
+    def seek(self, offset: int):
+        raise io.UnsupportedOperation('compact recordings are not seekable')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Converts Kaillera recordings (*.krec) to and from a compact '
+        f"run-length encoded archive (*{ARCHIVE_EXTENSION})"
+    ))
+
+    parser.add_argument('file', nargs='+',
+                        help=f"recordings (*.krec or *{ARCHIVE_EXTENSION})")
+    parser.add_argument('-n', metavar='FRAMES', type=int, dest='block',
+                        help='values events per block '
+                        f"(default: {DEFAULT_BLOCK_FRAMES})")
+
+    parser.set_defaults(block=DEFAULT_BLOCK_FRAMES)
+    return parser.parse_args()
+
+
+def main(args):
+    for file in args.file:
+        base, ext = os.path.splitext(file)
+        compact = ext.lower() == ARCHIVE_EXTENSION
+        output = base if compact else f"{file}{ARCHIVE_EXTENSION}"
+        try:
+            stream = open(output, 'xb')
+        except OSError as e:
+            print(f"Unable to convert {file}: {e}")
+            continue
+
+        try:
+            with stream:
+                if compact:
+                    size = decode(file, stream)
+                else:
+                    size = encode(file, stream, args.block)
+        except Exception as e:
+            os.remove(output)
+            print(f"Unable to convert {file}: {e}")
+            continue
+
+        ratio = size / max(os.path.getsize(file), 1)
+        print(f"{file} -> {output} ({size} bytes, {ratio:.1%})")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
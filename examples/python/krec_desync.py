@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import yaml
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+from krec_index import DEFAULT_INTERVAL, KrecIndex, load_index
+from krec_stream import *
+
+
+# sidecar: header, then one chained hash per checkpoint interval; hash k
+# covers every values event before frame (k + 1) * interval, so two
+# recordings agree on hash k exactly when they agree on all those frames
+HASHES_FORMAT = '<4sHHIIQq'
+HASHES_MAGIC = b'KHSH'
+HASHES_VERSION = 1
+HASHES_EXTENSION = '.hash'
+HASH_SIZE = 8
+
+
+@dataclass
+class FrameHashes:
+    interval: int
+    frames: int = 0
+    source_size: int = 0
+    source_mtime: int = 0
+    hashes: array = field(default_factory=lambda: array('Q'))
+
+    @classmethod
+    def build(cls, path: str, interval: int = DEFAULT_INTERVAL):
+        stat = os.stat(path)
+        result = cls(interval, 0, stat.st_size, stat.st_mtime_ns)
+        with open(path, 'rb') as stream:
+            read_header(stream)
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            with data:
+                result.__scan(data)
+        return result
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as stream:
+            header = stream.read(struct.calcsize(HASHES_FORMAT))
+            if len(header) < struct.calcsize(HASHES_FORMAT):
+                raise EOFError(f"{path} is not a complete hash file")
+
+            magic, version, _, interval, frames, size, mtime = \
+                struct.unpack(HASHES_FORMAT, header)
+            if magic != HASHES_MAGIC or version != HASHES_VERSION:
+                raise ValueError(
+                    f"{path} is not a version {HASHES_VERSION} hash file")
+            if interval < 1:
+                raise ValueError(f"{path} has an interval of {interval}")
+            return cls(interval, frames, size, mtime,
+                       read_array(stream, 'Q', frames // interval))
+
+    def save(self, path: str):
+        with open(path, 'wb') as stream:
+            stream.write(struct.pack(
+                HASHES_FORMAT, HASHES_MAGIC, HASHES_VERSION, 0,
+                self.interval, self.frames, self.source_size,
+                self.source_mtime))
+            write_array(stream, self.hashes)
+
+    def is_current(self, path: str) -> bool:
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns) == \
+            (self.source_size, self.source_mtime)
+
+    def __scan(self, data):
+        # only complete intervals get a hash, the tail is compared directly
+        chain = bytes(HASH_SIZE)
+        digest = hashlib.blake2b(chain, digest_size=HASH_SIZE)
+        for offset, length in values_records(data):
+            digest.update(data[offset:offset+length])
+            self.frames += 1
+            if self.frames % self.interval == 0:
+                chain = digest.digest()
+                self.hashes.append(int.from_bytes(chain, 'little'))
+                digest = hashlib.blake2b(chain, digest_size=HASH_SIZE)
+
+
+@dataclass
+class Divergence:
+    frame: int
+    players: list[int]              # player ids whose ports differ
+    groups: list[list[str]]         # recordings that agree with each other
+    size_differs: bool = False
+
+
+def hashes_path(path: str) -> str:
+    return f"{path}{HASHES_EXTENSION}"
+
+
+def load_hashes(path: str, interval: int = DEFAULT_INTERVAL) -> FrameHashes:
+    # same rules as load_index: reuse a current sidecar, otherwise rebuild
+    sidecar = hashes_path(path)
+    try:
+        hashes = FrameHashes.load(sidecar)
+        if hashes.interval == interval and hashes.is_current(path):
+            return hashes
+    except (OSError, EOFError, ValueError):
+        pass
+
+    hashes = FrameHashes.build(path, interval)
+    try:
+        hashes.save(sidecar)
+    except OSError:
+        pass
+    return hashes
+
+
+def values_records(data, offset: int = HEADER_SIZE) -> \
+        Iterator[tuple[int, int]]:
+    for offset, length in scan_records(data, offset):
+        if data[offset] == Event.VALUES:
+            yield offset, length
+
+
+def compare_frame(names: list[str], payloads: list[bytes],
+                  player_count: int) -> Optional[tuple[list, list, bool]]:
+    # None when every recording has the same values event
+    groups: dict[bytes, list[str]] = {}
+    for name, payload in zip(names, payloads):
+        groups.setdefault(payload, []).append(name)
+    if len(groups) == 1:
+        return None
+
+    sizes = set(len(payload) for payload in payloads)
+    players = set()
+    if len(sizes) == 1 and player_count > 0:
+        width = (len(payloads[0]) - 3) // player_count
+        for port in range(player_count if width else 0):
+            start = 3 + port * width
+            ports = set(payload[start:start+width] for payload in payloads)
+            if len(ports) > 1:
+                players.add(payloads[0][start + PORT_ID] - PLAYER_ID_BASE)
+    return sorted(players), list(groups.values()), len(sizes) > 1
+
+
+class Session(object):
+    # the recordings of one netplay session, one per player's client
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+        self.headers: list[RecordingHeader] = []
+        self.data: list[mmap.mmap] = []
+        try:
+            for path in paths:
+                with open(path, 'rb') as stream:
+                    self.headers.append(
+                        RecordingHeader.parse(read_header(stream)))
+                    self.data.append(mmap.mmap(
+                        stream.fileno(), 0, access=mmap.ACCESS_READ))
+
+            games = set(header.game_name for header in self.headers)
+            counts = set(header.player_count for header in self.headers)
+            if len(games) > 1 or len(counts) > 1:
+                raise ValueError('recordings are not from the same session')
+            self.player_count = counts.pop()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for data in self.data:
+            data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def lockstep(self, offsets: list[int] = None, frame: int = 0,
+                 end: int = None) -> Optional[Divergence]:
+        # streams every recording a values event at a time from offsets,
+        # which sit on frame, up to end or the shortest recording
+        offsets = offsets or [HEADER_SIZE] * len(self.data)
+        streams = [values_records(data, offset)
+                   for data, offset in zip(self.data, offsets)]
+        for records in zip(*streams):
+            if end is not None and frame >= end:
+                break
+            payloads = [data[offset:offset+length] for data, (offset, length)
+                        in zip(self.data, records)]
+            if payloads.count(payloads[0]) != len(payloads):
+                return Divergence(frame, *compare_frame(
+                    self.paths, payloads, self.player_count))
+            frame += 1
+        return None
+
+    def bisect(self, interval: int = DEFAULT_INTERVAL) -> \
+            tuple[Optional[Divergence], list[int]]:
+        # first interval whose chained hashes disagree, then that interval
+        # frame by frame; returns the divergence and each recording's frames
+        indices = [load_index(path, interval) for path in self.paths]
+        interval = indices[0].interval
+        indices = [index if index.interval == interval
+                   else KrecIndex.build(path, interval)
+                   for path, index in zip(self.paths, indices)]
+        hashes = [load_hashes(path, interval) for path in self.paths]
+
+        def differs(checkpoint: int) -> bool:
+            return len(set(entry.hashes[checkpoint] for entry in hashes)) > 1
+
+        common = min(len(entry.hashes) for entry in hashes)
+        first = bisect_left(range(common), True, key=differs)
+
+        frame = first * interval
+        frames = [index.frames for index in indices]
+        if frame >= min(frames):
+            return None, frames
+        end = frame + interval if first < common else None
+        offsets = [index.locate(frame)[0] for index in indices]
+        return self.lockstep(offsets, frame, end), frames
+
+
+def recording_frames(data) -> int:
+    return sum(1 for _ in values_records(data))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Finds the first frame where the recordings of one Kaillera netplay '
+        'session (*.krec) disagree'
+    ))
+    parser.add_argument('file', nargs='+',
+                        help='krec recordings of the same session')
+    parser.add_argument('-n', metavar='INTERVAL', type=int, dest='interval',
+                        help='frames between checkpoints '
+                        f"(default: {DEFAULT_INTERVAL})")
+    parser.add_argument('-s', dest='stream', action='store_true',
+                        help='stream the recordings without building or '
+                        'reading sidecar files')
+
+    parser.set_defaults(interval=DEFAULT_INTERVAL)
+    args = parser.parse_args()
+    if len(args.file) < 2:
+        parser.error('at least two recordings are needed')
+    if args.interval < 1:
+        parser.error('-n INTERVAL must be at least 1')
+    return args
+
+
+def main(args):
+    try:
+        with Session(args.file) as session:
+            if args.stream:
+                divergence = session.lockstep()
+                frames = [recording_frames(data) for data in session.data]
+            else:
+                divergence, frames = session.bisect(args.interval)
+            headers = session.headers
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    info = {
+        'recordings': [
+            {'name': path, 'player_id': header.player_id, 'frames': count}
+            for path, header, count in zip(args.file, headers, frames)
+        ],
+        'divergence': None,
+    }
+    if divergence:
+        info['divergence'] = {
+            'frame': divergence.frame,
+            'players': divergence.players,
+            'size differs': divergence.size_differs,
+            'groups': divergence.groups,
+        }
+    elif len(set(frames)) > 1:
+        info['divergence'] = {
+            'frame': min(frames),
+            'recordings end': True,
+        }
+    yaml.dump(info, sys.stdout, sort_keys=False)
+    if info['divergence']:
+        exit(2)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator
+from krec_stream import Event
+
+
+class Handler(ABC):
+    # receives (event index, Playback) for the event types it lists
+    events: tuple[Event, ...] = tuple(Event)
+
+    @abstractmethod
+    def __call__(self, index: int, event):
+        pass
+
+
+class StatsCounter(Handler):
+    def __init__(self):
+        self.counts = {event: 0 for event in Event}
+
+    def __call__(self, index: int, event):
+        self.counts[event.type.value] += 1
+
+    def stats(self) -> dict:
+        frames = self.counts[Event.VALUES]
+        return {
+            'events': sum(self.counts.values()),
+            'frames': frames,
+            'seconds': round(frames/60, 2),
+            'messages': self.counts[Event.CHAT],
+        }
+
+
+class ChatCollector(Handler):
+    events = (Event.CHAT,)
+
+    def __init__(self, transform: Callable = None):
+        self.transform = transform or (lambda index, event: (index, event))
+        self.messages = []
+
+    def __call__(self, index: int, event):
+        self.messages.append(self.transform(index, event))
+
+
+class FrameSink(Handler):
+    events = (Event.VALUES,)
+
+    def __init__(self, sink: Callable):
+        self.sink = sink
+
+    def __call__(self, index: int, event):
+        self.sink(index, event)
+
+
+class PortDetector(Handler):
+    # krec_pj64k only, relies on the port.player_id instance
+    events = (Event.VALUES,)
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.frames = 0
+        self.plugged = [False, False, False, False]
+
+    def __call__(self, index: int, event):
+        if self.limit and self.frames >= self.limit:
+            return
+
+        self.frames += 1
+        for port in event.data.values.ports:
+            if 1 <= port.player_id <= len(self.plugged):
+                self.plugged[port.player_id-1] = True
+
+
+class Dispatcher(object):
+    # routes every playback event to its handlers in a single pass
+    def __init__(self, *handlers: Handler):
+        self.handlers = {
+            event: [handler for handler in handlers if event in handler.events]
+            for event in Event
+        }
+
+    def dispatch(self, index: int, event):
+        type = getattr(event.type, 'value', event.type)
+        for handler in self.handlers.get(type, ()):
+            handler(index, event)
+
+    def run(self, playback: Iterable) -> int:
+        count = 0
+        for count, event in enumerate(playback, 1):
+            self.dispatch(count - 1, event)
+        return count
+
+    def select(self, playback: Iterable, type: Event) -> Iterator[tuple]:
+        # dispatches everything, yields (index, event) of one type
+        for index, event in enumerate(playback):
+            self.dispatch(index, event)
+            if getattr(event.type, 'value', event.type) == type:
+                yield index, event
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import time
+from typing import BinaryIO, Iterator, Optional
+from info import format_message
+from krec_stream import *
+from lib.krec import *
+
+
+DEFAULT_POLL = 0.25
+
+
+class FollowPlayback(PlaybackStream):
+    # playback of a recording that is still being written, a trailing
+    # record stays buffered until the client has appended the rest of it
+    def __init__(self, krec, stream: BinaryIO, poll: float = DEFAULT_POLL,
+                 idle: Optional[float] = None):
+        super().__init__(krec, stream)
+        self.poll = poll
+        self.idle = idle
+        self.stopped = False
+
+    @classmethod
+    def from_file(cls, krec, path: str, poll: float = DEFAULT_POLL,
+                  idle: Optional[float] = None):
+        # the client may not have flushed the header yet
+        wait_for_size(path, HEADER_SIZE, poll, idle)
+        stream = open(path, 'rb')
+        try:
+            return cls(krec, stream, poll, idle)
+        except Exception:
+            stream.close()
+            raise
+
+    def stop(self):
+        self.stopped = True
+
+    def records(self) -> Iterator[Record]:
+        # self.offset is kept at the end of the last complete record, a
+        # later seek(offset) resumes exactly there
+        scanner = RecordScanner(self.offset)
+        read = getattr(self.stream, 'read1', self.stream.read)
+        last_data = time.monotonic()
+
+        while not self.stopped:
+            data = read(CHUNK_SIZE)
+            if data:
+                last_data = time.monotonic()
+                scanner.feed(data)
+                for record in scanner.records():
+                    self.offset = record.offset + len(record.raw)
+                    yield record
+                    if self.stopped:
+                        return
+                continue
+
+            size = os.fstat(self.stream.fileno()).st_size
+            if size < scanner.offset + scanner.pending:
+                raise EOFError(
+                    f"recording shrank to {size} bytes, "
+                    f"{scanner.offset + scanner.pending} already read")
+            if self.idle is not None and \
+                    time.monotonic() - last_data >= self.idle:
+                return
+            time.sleep(self.poll)
+
+
+def wait_for_size(path: str, size: int, poll: float = DEFAULT_POLL,
+                  idle: Optional[float] = None):
+    start = time.monotonic()
+    while True:
+        try:
+            if os.path.getsize(path) >= size:
+                return
+        except FileNotFoundError:
+            pass
+        if idle is not None and time.monotonic() - start >= idle:
+            raise EOFError(f"{path} has no complete header after {idle}s")
+        time.sleep(poll)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Follows a Kaillera recording while it is being written'
+    ))
+
+    parser.add_argument('file', help='krec recording (*.krec)')
+    parser.add_argument('-i', metavar='SECONDS', type=float, dest='poll',
+                        help=f"poll interval (default: {DEFAULT_POLL})")
+    parser.add_argument('-t', metavar='SECONDS', type=float, dest='idle',
+                        help='stop after this long without new records '
+                        '(default: never)')
+    parser.add_argument('-o', metavar='OFFSET', type=int, dest='offset',
+                        help='resume from a record offset printed earlier')
+
+    parser.set_defaults(poll=DEFAULT_POLL)
+    return parser.parse_args()
+
+
+def main(args):
+    try:
+        playback = FollowPlayback.from_file(
+            Krec, args.file, args.poll, args.idle)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    # chats are timed by event index like info.py, both count from -o
+    frames = events = 0
+    start_time = playback.header.time
+    with playback:
+        if args.offset:
+            playback.seek(args.offset)
+
+        try:
+            for event in playback:
+                match event.type:
+                    case Krec.Playback.Event.values:
+                        frames += 1
+                    case Krec.Playback.Event.chat:
+                        print(format_message(
+                            events, event.data.nickname, event.data.message,
+                            start_time))
+                    case Krec.Playback.Event.drop:
+                        print(f"{event.data.nickname} (player "
+                              f"{event.data.player_id}) dropped at frame "
+                              f"{frames}")
+                events += 1
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(e)
+
+    print(f"{frames} frames, resume with -o {playback.offset}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
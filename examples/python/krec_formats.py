@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import struct
+import time
+import numpy as np
+from abc import ABC, abstractmethod
+from array import array
+from typing import Iterable, Optional
+from bizhawk import *
+from krec_dispatch import *
+from krec_stream import Event, OS_CONT_PAD_BUTTONS, Pad, PlaybackStream, \
+    RecordingHeader, probe_header, probe_ports
+from krec_to_bk2 import krec_mapping, parse_message, read_pads
+from lib.krec_pj64k import KrecPj64k as Krec
+
+# one entry per controller port, None when the port sent no os_cont_pad
+Frame = list[Optional[Pad]]
+
+# mupen64 movie, version 3 header (0x400 bytes) then one sample per frame
+M64_HEADER = struct.Struct(
+    '<4sIIIIBB2xIH2xI160x32sIH56x64s64s64s64s222s256s')
+M64_MAGIC = b'M64\x1a'
+M64_VERSION = 3
+M64_POWER_ON = 2
+
+# csv button names, most significant bit first like krec_frames.BUTTONS
+CSV_BUTTONS = tuple(
+    (mask, name) for name, mask in sorted(
+        OS_CONT_PAD_BUTTONS.items(), key=lambda item: -item[1])
+    if not name.startswith('reserved'))
+
+
+class FrameWriter(ABC):
+    # streams frames to one output file; abort removes what was written
+    extension = ''
+
+    def __init__(self, output: str, header: RecordingHeader,
+                 ports: list[bool]):
+        self.output = output
+        self.header = header
+        self.ports = ports
+        self.frames = 0
+
+    @abstractmethod
+    def write(self, frame: Frame):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        if os.path.exists(self.output):
+            os.remove(self.output)
+
+
+class Bk2Writer(FrameWriter):
+    extension = '.bk2'
+
+    def __init__(self, output: str, header: RecordingHeader,
+                 ports: list[bool], original: str, game: Game,
+                 subtitles: list[Subtitle], ver: float = 2.8,
+                 core: BizHawk.Core = BizHawk.Core.MUPEN64PLUS):
+        super().__init__(output, header, ports)
+        self.bizhawk = BizHawk(ver=ver, core=core, game=game, ports=ports)
+        self.bizhawk.subtitles = subtitles
+        self.input_log = krec_mapping(self.bizhawk)
+        self.stream = Bk2Stream(self.bizhawk, original, output)
+
+    def write(self, frame: Frame):
+        self.stream.write(self.input_log.__str__(frame))
+        self.frames += 1
+
+    def close(self):
+        self.stream.close()
+
+    def abort(self):
+        self.stream.abort()
+
+
+class M64Writer(FrameWriter):
+    # 4 bytes per plugged controller and frame: the button word with its
+    # bytes swapped into mupen's BUTTONS order, then the two axes
+    extension = '.m64'
+
+    def __init__(self, output: str, header: RecordingHeader,
+                 ports: list[bool], game: Game = None):
+        super().__init__(output, header, ports)
+        self.game = game
+        self.stream = open(output, 'wb')
+        self.stream.write(bytes(M64_HEADER.size))
+
+    def write(self, frame: Frame):
+        sample = []
+        for pad, plugged in zip(frame, self.ports):
+            if not plugged:
+                continue
+            if pad is None:
+                sample.append(bytes(4))
+            else:
+                sample.append(struct.pack(
+                    '>Hbb', pad.button, pad.stick_x, pad.stick_y))
+        self.stream.write(b''.join(sample))
+        self.frames += 1
+
+    def close(self):
+        rom = self.game.rom_header() if self.game else b''
+        name = rom[ROM_NAME_OFFSET:ROM_NAME_OFFSET+ROM_NAME_SIZE] or \
+            self.header.game_name.encode('utf-8')[:32]
+        crc, country = 0, 0
+        if rom:
+            crc, = struct.unpack_from('>I', rom, ROM_CRC_OFFSET)
+            country = rom[ROM_COUNTRY_OFFSET]
+
+        flags = sum(1 << port for port, plugged in enumerate(self.ports)
+                    if plugged)
+        self.stream.seek(0)
+        self.stream.write(M64_HEADER.pack(
+            M64_MAGIC, M64_VERSION, self.header.time & 0xffffffff,
+            self.frames, 0, 60, sum(self.ports), self.frames,
+            M64_POWER_ON, flags, name, crc, country, b'', b'', b'', b'',
+            self.header.app_name.encode('utf-8')[:222],
+            f"Converted from {self.header.game_name}".encode('utf-8')[:256]))
+        self.stream.close()
+
+    def abort(self):
+        self.stream.close()
+        super().abort()
+
+
+class CsvWriter(FrameWriter):
+    # one row per frame: pressed buttons and both axes of each player
+    extension = '.csv'
+
+    def __init__(self, output: str, header: RecordingHeader,
+                 ports: list[bool]):
+        super().__init__(output, header, ports)
+        self.stream = open(output, 'w', newline='')
+        self.writer = csv.writer(self.stream)
+        columns = ['frame']
+        for port, plugged in enumerate(ports):
+            if plugged:
+                columns += [f"P{port+1} Buttons", f"P{port+1} X",
+                            f"P{port+1} Y"]
+        self.writer.writerow(columns)
+
+    def write(self, frame: Frame):
+        row = [self.frames]
+        for pad, plugged in zip(frame, self.ports):
+            if not plugged:
+                continue
+            if pad is None:
+                row += ['', '', '']
+                continue
+            buttons = ' '.join(
+                name for mask, name in CSV_BUTTONS if pad.button & mask)
+            row += [buttons, pad.stick_x, pad.stick_y]
+        self.writer.writerow(row)
+        self.frames += 1
+
+    def close(self):
+        self.stream.close()
+
+    def abort(self):
+        self.stream.close()
+        super().abort()
+
+
+class ColumnarWriter(FrameWriter):
+    # numpy .npz, one column per player and field (p1_button, p1_stick_x,
+    # p1_stick_y, p1_present), plus the recording header
+    extension = '.npz'
+
+    def __init__(self, output: str, header: RecordingHeader,
+                 ports: list[bool]):
+        super().__init__(output, header, ports)
+        self.columns = {}
+        for port in range(len(ports)):
+            self.columns.update({
+                f"p{port+1}_button": array('H'),
+                f"p{port+1}_stick_x": array('b'),
+                f"p{port+1}_stick_y": array('b'),
+                f"p{port+1}_present": array('B'),
+            })
+
+    def write(self, frame: Frame):
+        for port in range(len(self.ports)):
+            pad = frame[port] or Pad(0, 0, 0)
+            self.columns[f"p{port+1}_button"].append(pad.button)
+            self.columns[f"p{port+1}_stick_x"].append(pad.stick_x)
+            self.columns[f"p{port+1}_stick_y"].append(pad.stick_y)
+            self.columns[f"p{port+1}_present"].append(
+                frame[port] is not None)
+        self.frames += 1
+
+    def close(self):
+        columns = {name: np.frombuffer(column, dtype=column.typecode)
+                   for name, column in self.columns.items()}
+        columns['plugged'] = np.array(self.ports, dtype=bool)
+        columns['game_name'] = np.array(self.header.game_name)
+        columns['time'] = np.array(self.header.time)
+        # savez adds .npz to names without it
+        with open(self.output, 'wb') as stream:
+            np.savez_compressed(stream, **columns)
+
+
+WRITERS = {
+    'bk2': Bk2Writer,
+    'm64': M64Writer,
+    'csv': CsvWriter,
+    'npz': ColumnarWriter,
+}
+
+
+def fan_out(frames: Iterable[Frame], writers: list[FrameWriter]) -> int:
+    # a single pass over frames, every writer sees each frame in turn
+    count = 0
+    try:
+        for frame in frames:
+            for writer in writers:
+                writer.write(frame)
+            count += 1
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    for id, writer in enumerate(writers):
+        try:
+            writer.close()
+        except BaseException:
+            for pending in writers[id:]:
+                pending.abort()
+            raise
+    return count
+
+
+def convert(krec_path: str, formats: list[str], rom_path: str = None,
+            ver: float = 2.8,
+            core: BizHawk.Core = BizHawk.Core.MUPEN64PLUS) -> list[str]:
+    # the port id scan reads no pads, the frames are decoded once below
+    ports = probe_ports(krec_path)
+    header = probe_header(krec_path)
+    with PlaybackStream.from_file(Krec, krec_path) as playback:
+        game = Game(header.game_name, rom_path) if rom_path else None
+        chats = ChatCollector(parse_message)
+        dispatcher = Dispatcher(chats)
+
+        writers = []
+        try:
+            for format in formats:
+                output = f"{krec_path}{WRITERS[format].extension}"
+                match format:
+                    case 'bk2':
+                        if not game:
+                            raise ValueError('bk2 needs a ROM (-r)')
+                        writer = Bk2Writer(output, header, ports, krec_path,
+                                           game, chats.messages, ver, core)
+                    case 'm64':
+                        writer = M64Writer(output, header, ports, game)
+                    case _:
+                        writer = WRITERS[format](output, header, ports)
+                writers.append(writer)
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+
+        events = map(playback.parse, playback.records())
+        values = dispatcher.select(events, Event.VALUES)
+        fan_out((read_pads(playback, copy=True) for _, playback in values),
+                writers)
+    return [writer.output for writer in writers]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Converts a Kaillera recording (*.krec) to several formats in one '
+        'pass'
+    ))
+
+    parser.add_argument('file', nargs='+', help='krec recording (*.krec)')
+    parser.add_argument('-f', metavar='FORMAT', dest='formats',
+                        help='comma separated output formats: '
+                        f"{', '.join(WRITERS)} (default: all, bk2 only "
+                        'with -r)')
+    parser.add_argument('-r', metavar='ROM', dest='rom',
+                        help='ROM file used with the recording (*.z64), '
+                        'needed for bk2')
+    parser.add_argument('-v', metavar='VERSION', dest='ver',
+                        help='BizHawk emulator version (default: 2.8)')
+
+    parser.set_defaults(ver=2.8)
+    args = parser.parse_args()
+    if not args.formats:
+        args.formats = ','.join(
+            format for format in WRITERS if args.rom or format != 'bk2')
+    args.formats = [format.strip() for format in args.formats.split(',')]
+    unknown = [format for format in args.formats if format not in WRITERS]
+    if unknown:
+        parser.error(f"unknown format {', '.join(unknown)}")
+    return args
+
+
+def main(args):
+    failed = False
+    for file in args.file:
+        start = time.perf_counter()
+        try:
+            outputs = convert(file, args.formats, args.rom, args.ver)
+        except Exception as e:
+            print(f"Unable to convert {file}: {e}")
+            failed = True
+            continue
+        elapsed = time.perf_counter() - start
+        print(f"{file} -> {', '.join(outputs)} ({elapsed:.2f}s)")
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
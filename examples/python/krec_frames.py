@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import struct
+import numpy as np
+from io import BytesIO
+from typing import Callable
+from krec_stream import *
+
+# os_cont_pad.button bits, most significant first (np.unpackbits order)
+BUTTONS = tuple(sorted(
+    OS_CONT_PAD_BUTTONS, key=OS_CONT_PAD_BUTTONS.get, reverse=True))
+BUTTONS_DTYPE = np.dtype([(name, '?') for name in BUTTONS])
+
+PORTS_DTYPE = np.dtype([
+    ('frame', '<u4'),       # index of the values event
+    ('player_id', 'i1'),
+    ('type', 'i1'),
+    ('has_pad', '?'),       # False for apply_cheat and non read_values
+    ('button', '<u2'),
+    ('stick_x', 'i1'),
+    ('stick_y', 'i1'),
+])
+
+
+def unpack_buttons(button: np.ndarray) -> np.ndarray:
+    raw = np.ascontiguousarray(button, dtype='>u2').view(np.uint8)
+    bits = np.unpackbits(raw.reshape(-1, 2), axis=1)
+    return bits.view(BUTTONS_DTYPE).reshape(-1)
+
+
+def _decode_group(rows: np.ndarray, frames: np.ndarray) -> np.ndarray:
+    ports = np.zeros(len(rows), dtype=PORTS_DTYPE)
+    ports['frame'] = frames
+    ports['player_id'] = rows[:, PORT_ID].view(np.int8) - PLAYER_ID_BASE
+    ports['type'] = rows[:, PORT_TYPE].view(np.int8)
+
+    width = rows.shape[1]
+    offsets = np.full(len(rows), -1, dtype=np.intp)
+    if width >= GET_KEYS_PAD + OS_CONT_PAD_SIZE:
+        offsets[ports['type'] == PortType.GET_KEYS] = GET_KEYS_PAD
+    if width >= READ_CONTROLLER_PAD + OS_CONT_PAD_SIZE:
+        read_values = (
+            (ports['type'] == PortType.READ_CONTROLLER) &
+            (rows[:, READ_CONTROLLER_TX] == READ_VALUES) &
+            (rows[:, READ_CONTROLLER_RX_LEN] >= OS_CONT_PAD_SIZE))
+        offsets[read_values] = READ_CONTROLLER_PAD
+
+    for offset in (GET_KEYS_PAD, READ_CONTROLLER_PAD):
+        mask = offsets == offset
+        if not mask.any():
+            continue
+        pad = rows[mask, offset:offset+OS_CONT_PAD_SIZE]
+        ports['has_pad'][mask] = True
+        ports['button'][mask] = (pad[:, 0].astype(np.uint16) << 8) | pad[:, 1]
+        ports['stick_x'][mask] = pad[:, 2].view(np.int8)
+        ports['stick_y'][mask] = pad[:, 3].view(np.int8)
+    return ports
+
+
+def decode_ports(buffer, player_count: int,
+                 other: Callable = None) -> np.ndarray:
+    # one row per port of every values event, grouped by port size so each
+    # group decodes as a single (ports, size) uint8 matrix. chat and drop
+    # records go to other(offset, length, frame) in the same scan
+    groups: dict[int, tuple[bytearray, list[int]]] = {}
+    frame = 0
+    for offset, length in scan_records(buffer):
+        if buffer[offset] != Event.VALUES:
+            if other:
+                other(offset, length, frame)
+            continue
+
+        size = length - 3
+        width = size // player_count if player_count > 0 else 0
+        if width > 0:
+            count = size // width
+            blob, frames = groups.setdefault(width, (bytearray(), []))
+            blob += buffer[offset+3:offset+3+count*width]
+            frames.extend([frame] * count)
+        frame += 1
+
+    decoded = [
+        _decode_group(
+            np.frombuffer(blob, dtype=np.uint8).reshape(-1, width),
+            np.array(frames, dtype=np.uint32))
+        for width, (blob, frames) in groups.items()
+    ]
+    if not decoded:
+        return np.zeros(0, dtype=PORTS_DTYPE)
+
+    ports = np.concatenate(decoded)
+    if len(decoded) > 1:
+        ports = ports[np.argsort(ports['frame'], kind='stable')]
+    return ports
+
+
+def decode_bytes(data: bytes) -> np.ndarray:
+    header = read_header(BytesIO(data))
+    player_count = struct.unpack(HEADER_FORMAT, header)[-1]
+    return decode_ports(data, player_count)
+
+
+def decode_file(path: str) -> np.ndarray:
+    with open(path, 'rb') as stream:
+        return decode_bytes(stream.read())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+from array import array
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterator
+from krec_stream import Event, PlaybackStream, read_array, read_header, \
+    scan_records, write_array
+
+
+# sidecar: header, checkpoint offsets, then chat/drop offsets, frames, types
+INDEX_FORMAT = '<4sHHIIIQq'
+INDEX_MAGIC = b'KIDX'
+INDEX_VERSION = 1
+INDEX_EXTENSION = '.idx'
+DEFAULT_INTERVAL = 64
+
+
+@dataclass
+class KrecIndex:
+    interval: int
+    frames: int = 0
+    source_size: int = 0
+    source_mtime: int = 0
+    checkpoints: array = field(default_factory=lambda: array('Q'))
+    event_offsets: array = field(default_factory=lambda: array('Q'))
+    event_frames: array = field(default_factory=lambda: array('I'))
+    event_types: array = field(default_factory=lambda: array('B'))
+
+    @classmethod
+    def build(cls, path: str, interval: int = DEFAULT_INTERVAL):
+        if interval < 1:
+            raise ValueError(f"interval must be positive, not {interval}")
+
+        stat = os.stat(path)
+        index = cls(interval, 0, stat.st_size, stat.st_mtime_ns)
+        with open(path, 'rb') as stream:
+            read_header(stream)
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            with data:
+                index.__scan(data)
+        return index
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'rb') as stream:
+            header = stream.read(struct.calcsize(INDEX_FORMAT))
+            if len(header) < struct.calcsize(INDEX_FORMAT):
+                raise EOFError(f"{path} is not a complete index")
+
+            magic, version, _, interval, frames, events, size, mtime = \
+                struct.unpack(INDEX_FORMAT, header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError(
+                    f"{path} is not a version {INDEX_VERSION} index")
+            if interval < 1:
+                raise ValueError(f"{path} has an interval of {interval}")
+
+            checkpoints = -(-frames // interval)
+            return cls(
+                interval, frames, size, mtime,
+                read_array(stream, 'Q', checkpoints),
+                read_array(stream, 'Q', events),
+                read_array(stream, 'I', events),
+                read_array(stream, 'B', events))
+
+    def save(self, path: str):
+        with open(path, 'wb') as stream:
+            stream.write(struct.pack(
+                INDEX_FORMAT, INDEX_MAGIC, INDEX_VERSION, 0, self.interval,
+                self.frames, len(self.event_offsets), self.source_size,
+                self.source_mtime))
+            write_array(stream, self.checkpoints)
+            write_array(stream, self.event_offsets)
+            write_array(stream, self.event_frames)
+            write_array(stream, self.event_types)
+
+    def is_current(self, path: str) -> bool:
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns) == \
+            (self.source_size, self.source_mtime)
+
+    def locate(self, frame: int) -> tuple[int, int]:
+        # offset of the nearest checkpoint and values events left to skip
+        if not 0 <= frame < self.frames:
+            raise IndexError(f"frame {frame} not in 0..{self.frames - 1}")
+        checkpoint, skip = divmod(frame, self.interval)
+        return self.checkpoints[checkpoint], skip
+
+    def events(self, type: Event, begin: int = 0,
+               end: int = None) -> Iterator[tuple[int, int]]:
+        # (offset, frame) of every chat or drop event, or of those at
+        # offsets begin..end - 1, found by bisecting the sorted offsets
+        offsets = self.event_offsets
+        first = bisect.bisect_left(offsets, begin)
+        last = len(offsets) if end is None else \
+            bisect.bisect_left(offsets, end, first)
+        for id in range(first, last):
+            if self.event_types[id] == type:
+                yield offsets[id], self.event_frames[id]
+
+    def __scan(self, data):
+        for offset, _ in scan_records(data):
+            event = data[offset]
+            if event == Event.VALUES:
+                if self.frames % self.interval == 0:
+                    self.checkpoints.append(offset)
+                self.frames += 1
+            else:
+                self.event_offsets.append(offset)
+                self.event_frames.append(self.frames)
+                self.event_types.append(event)
+
+
+def index_path(path: str) -> str:
+    return f"{path}{INDEX_EXTENSION}"
+
+
+def load_index(path: str, interval: int = DEFAULT_INTERVAL) -> KrecIndex:
+    # reuse the sidecar when it matches the recording, otherwise rebuild it
+    sidecar = index_path(path)
+    try:
+        index = KrecIndex.load(sidecar)
+        if index.is_current(path):
+            return index
+    except (OSError, EOFError, ValueError):
+        pass
+
+    index = KrecIndex.build(path, interval)
+    try:
+        index.save(sidecar)
+    except OSError:
+        pass
+    return index
+
+
+class IndexedPlayback(PlaybackStream):
+    def __init__(self, krec, stream: BinaryIO, index: KrecIndex):
+        super().__init__(krec, stream)
+        self.index = index
+
+    @classmethod
+    def from_file(cls, krec, path: str, interval: int = DEFAULT_INTERVAL):
+        index = load_index(path, interval)
+        stream = open(path, 'rb')
+        try:
+            return cls(krec, stream, index)
+        except Exception:
+            stream.close()
+            raise
+
+    def seek_frame(self, frame: int):
+        # playback events from the values event of the given frame onwards
+        offset, skip = self.index.locate(frame)
+        self.seek(offset)
+
+        records = self.records()
+        for record in records:
+            if record.type == Event.VALUES:
+                if not skip:
+                    yield self.parse(record)
+                    break
+                skip -= 1
+
+        for record in records:
+            yield self.parse(record)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Builds a frame index (*.krec.idx) next to Kaillera recordings'
+    ))
+    parser.add_argument('file', nargs='+', help='krec recording (*.krec)')
+    parser.add_argument('-n', metavar='INTERVAL', type=int, dest='interval',
+                        default=DEFAULT_INTERVAL,
+                        help='frames between offsets '
+                        f"(default: {DEFAULT_INTERVAL})")
+    args = parser.parse_args()
+    if args.interval < 1:
+        parser.error('-n INTERVAL must be at least 1')
+    return args
+
+
+def main(args):
+    for file in args.file:
+        try:
+            index = KrecIndex.build(file, args.interval)
+            index.save(index_path(file))
+        except Exception as e:
+            print(f"Unable to index {file}: {e}")
+            continue
+        print(f"{index_path(file)}: {index.frames} frames")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
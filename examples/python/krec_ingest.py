@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import io
+import os
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from bizhawk import BizHawk, Game
+from info import get_header, get_message
+from krec_dispatch import ChatCollector, StatsCounter
+from krec_stream import *
+from krec_to_bk2 import Krec, convert_playback
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 27886
+
+
+class IngestServer(object):
+    # connections are read on the event loop, decoding and bk2 writing
+    # happen on a bounded pool of worker threads. a conversion starts once
+    # its upload is complete: the bk2 needs the ports of the whole
+    # recording before its first input line
+    def __init__(self, output: str, rom: str, ver: float,
+                 core: BizHawk.Core, jobs: int = os.cpu_count()):
+        self.output = output
+        self.rom = rom
+        self.digest = Game('', rom).sha1()
+        self.ver = ver
+        self.core = core
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = asyncio.Semaphore(jobs)
+        self.uploads = 0
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        # waiting connections are not read, tcp pushes back on the client
+        try:
+            async with self.slots:
+                summary = await self.ingest(reader)
+            writer.write(yaml.dump(summary, sort_keys=False).encode('utf-8'))
+        except Exception as e:
+            writer.write(f"error: {e}\n".encode('utf-8'))
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def ingest(self, reader: asyncio.StreamReader) -> dict:
+        self.uploads += 1
+        name = (await reader.readline()).decode('utf-8').strip()
+        name = os.path.basename(name) or f"upload-{self.uploads}.krec"
+        try:
+            header = await reader.readexactly(HEADER_SIZE)
+        except asyncio.IncompleteReadError as e:
+            header = e.partial
+        read_header(io.BytesIO(header))
+
+        # the original recording goes into the bk2, it is kept whole anyway
+        data = io.BytesIO()
+        data.write(header)
+        while chunk := await reader.read(CHUNK_SIZE):
+            data.write(chunk)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.convert, name, data)
+
+    def convert(self, name: str, data: io.BytesIO) -> dict:
+        raw = data.getvalue()
+        playback = PlaybackStream(Krec, io.BytesIO(raw))
+        # same full port detection as krec_to_bk2.convert, over the upload
+        ports = scan_ports(raw, playback.header.player_count)
+        start_time = playback.header.time
+        stats = StatsCounter()
+        chats = ChatCollector(lambda id, e: get_message(id, e, start_time))
+
+        output = os.path.join(self.output, f"{name}.bk2")
+        output, _ = convert_playback(
+            playback, name, output, self.rom, self.ver, self.core,
+            self.digest, (stats, chats), data, ports)
+        return {
+            'krec': {
+                'name': name,
+                'bk2': output,
+                'header': get_header(playback.header),
+                'stats': stats.stats(),
+                'messages': chats.messages
+            }
+        }
+
+
+async def upload(path: str, host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT) -> str:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"{os.path.basename(path)}\n".encode('utf-8'))
+        with open(path, 'rb') as stream:
+            while chunk := stream.read(CHUNK_SIZE):
+                writer.write(chunk)
+                await writer.drain()
+        writer.write_eof()
+        return (await reader.read()).decode('utf-8')
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def upload_all(paths: list[str], host: str, port: int):
+    results = await asyncio.gather(
+        *(upload(path, host, port) for path in paths), return_exceptions=True)
+    for path, result in zip(paths, results):
+        if isinstance(result, Exception):
+            result = f"error: {result}\n"
+        print(result)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Accepts Kaillera recordings over TCP and converts each to a Bizhawk '
+        'TAS (*.bk2) as soon as its upload is complete'
+    ))
+
+    parser.add_argument('-u', metavar='KREC', dest='uploads', nargs='+',
+                        help='upload recordings to a running server '
+                        'instead of serving')
+    parser.add_argument('-H', metavar='HOST', dest='host',
+                        help="address to listen on or upload to "
+                        f"(default: {DEFAULT_HOST})")
+    parser.add_argument('-p', metavar='PORT', type=int, dest='port',
+                        help=f"port (default: {DEFAULT_PORT})")
+    parser.add_argument('-r', metavar='ROM', dest='rom',
+                        help='ROM file used with the recordings (*.z64)')
+    parser.add_argument('-o', metavar='DIR', dest='output',
+                        help='directory for bk2 archives (default: .)')
+    parser.add_argument('-v', metavar='VERSION', dest='ver',
+                        help='BizHawk emulator version (default: 2.8)')
+    parser.add_argument('-j', metavar='JOBS', type=int, dest='jobs',
+                        help='concurrent conversions (default: cpu count)')
+    # -a/-p/-m of krec_to_bk2 would clash with -p PORT
+    cores = {core.name.lower().replace('_', '-'): core
+             for core in BizHawk.Core}
+    parser.add_argument('-c', metavar='CORE', dest='core', choices=cores,
+                        help=f"emulator core: {', '.join(cores)} "
+                        '(default: mupen64plus)')
+
+    parser.set_defaults(host=DEFAULT_HOST, port=DEFAULT_PORT, output='.',
+                        ver=2.8, jobs=os.cpu_count(), core='mupen64plus')
+    args = parser.parse_args()
+    if not args.uploads and not args.rom:
+        parser.error('-r ROM is required unless uploading with -u')
+    args.core = cores[args.core]
+    return args
+
+
+def main(args):
+    if args.uploads:
+        asyncio.run(upload_all(args.uploads, args.host, args.port))
+        return
+
+    try:
+        server = IngestServer(args.output, args.rom, args.ver, args.core,
+                              args.jobs)
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(e)
+        exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterable, Iterator, Optional
+
+
+def peak_rss() -> int:
+    # bytes, resource is only imported for reports; ru_maxrss is in KiB
+    # except on macOS, where it already is in bytes
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+@dataclass
+class StageStats:
+    seconds: float = 0.0
+    calls: int = 0
+    events: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_memory: int = 0        # bytes, only measured with tracemalloc
+
+    def merge(self, other: dict):
+        for key, value in other.items():
+            if key == 'peak_memory':
+                self.peak_memory = max(self.peak_memory, value)
+            else:
+                setattr(self, key, getattr(self, key) + value)
+
+
+class Metrics(object):
+    # time is exclusive: while a nested stage runs, the outer one is paused,
+    # so lazily chained generators are charged for their own work only
+    def __init__(self, enabled: bool = True, trace_memory: bool = False,
+                 profile: bool = False):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.stages: dict[str, StageStats] = {}
+        self.profiles: dict = {}            # stage name: cProfile.Profile
+        self.snapshot = None                # tracemalloc.Snapshot
+        self.snapshot_stage = ''
+        self.snapshot_peak = 0
+        self.stack: list[str] = []
+        self.last = time.perf_counter()
+
+        # the profilers are only imported when asked for, metrics are
+        # created on every conversion
+        self.tracemalloc = None
+        if self.trace_memory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def __bool__(self):
+        return self.enabled
+
+    def stats(self, name: str) -> StageStats:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageStats()
+        return stage
+
+    def __switch(self, name: Optional[str]):
+        # charge the time since the last switch to the running stage
+        now = time.perf_counter()
+        current = self.stack[-1] if self.stack else None
+        if current:
+            stage = self.stages[current]
+            stage.seconds += now - self.last
+            if self.tracemalloc:
+                _, peak = self.tracemalloc.get_traced_memory()
+                stage.peak_memory = max(stage.peak_memory, peak)
+                if peak > self.snapshot_peak * 1.1:
+                    # allocation sites near the overall peak
+                    self.snapshot = self.tracemalloc.take_snapshot()
+                    self.snapshot_stage = current
+                    self.snapshot_peak = peak
+            if self.profile:
+                self.profiles[current].disable()
+
+        if self.tracemalloc:
+            self.tracemalloc.reset_peak()
+        if name and self.profile:
+            import cProfile
+            self.profiles.setdefault(name, cProfile.Profile()).enable()
+        self.last = time.perf_counter()
+
+    def enter(self, name: str):
+        self.stats(name).calls += 1
+        self.__switch(name)
+        self.stack.append(name)
+
+    def exit(self):
+        outer = self.stack[-2] if len(self.stack) > 1 else None
+        self.__switch(outer)
+        self.stack.pop()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield self.stats(name)
+            return
+
+        self.enter(name)
+        try:
+            yield self.stages[name]
+        finally:
+            self.exit()
+
+    def iterate(self, name: str, iterable: Iterable,
+                size: Callable = None) -> Iterator:
+        # times every step of a lazy iterable as its own stage
+        if not self.enabled:
+            return iter(iterable)
+        return self.__iterate(name, iter(iterable), size)
+
+    def __iterate(self, name: str, iterator: Iterator, size: Callable):
+        stage = self.stats(name)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            stage.events += 1
+            if size:
+                stage.bytes_read += size(item)
+            yield item
+
+    def merge(self, stages: dict[str, dict]):
+        for name, other in stages.items():
+            self.stats(name).merge(other)
+
+    def to_dict(self) -> dict:
+        return {
+            'stages': {
+                name: asdict(stage) for name, stage in self.stages.items()
+            },
+            'peak rss KiB': peak_rss() // 1024,
+        }
+
+    def to_json(self) -> str:
+        import json
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'krec') -> str:
+        lines = []
+        for field, unit in (('seconds', 'seconds_total'),
+                            ('calls', 'calls_total'),
+                            ('events', 'events_total'),
+                            ('bytes_read', 'read_bytes_total'),
+                            ('bytes_written', 'written_bytes_total'),
+                            ('peak_memory', 'peak_memory_bytes')):
+            metric = f"{prefix}_stage_{unit}"
+            kind = 'gauge' if field == 'peak_memory' else 'counter'
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, stage in self.stages.items():
+                lines.append(
+                    f"{metric}{{stage=\"{name}\"}} {getattr(stage, field)}")
+
+        metric = f"{prefix}_peak_rss_bytes"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {peak_rss()}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, directory: str, top: int = 25):
+        # <stage>.prof for pstats / snakeviz and <stage>.txt with the hottest
+        # functions, tracemalloc.txt with the allocation sites near the peak
+        import pstats
+        os.makedirs(directory, exist_ok=True)
+        for name, profile in self.profiles.items():
+            path = os.path.join(directory, name.replace('/', '_'))
+            profile.dump_stats(f"{path}.prof")
+            with open(f"{path}.txt", 'w') as output:
+                pstats.Stats(profile, stream=output) \
+                    .sort_stats('cumulative').print_stats(top)
+
+        if self.snapshot:
+            path = os.path.join(directory, 'tracemalloc.txt')
+            with open(path, 'w') as output:
+                output.write(f"{self.snapshot_peak} bytes traced during "
+                             f"{self.snapshot_stage}\n")
+                for stat in self.snapshot.statistics('lineno')[:top]:
+                    output.write(f"{stat}\n")
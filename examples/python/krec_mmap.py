@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import mmap
+import struct
+from typing import Iterator
+from kaitaistruct import KaitaiStream
+from krec_stream import *
+
+
+PORT_HEADER = struct.Struct('<bb')
+OS_CONT_PAD = struct.Struct('>Hbb')
+READ_CONTROLLER_PIF = struct.Struct('<BB')
+
+
+class MappedRecording(object):
+    # records are memoryview slices of the mapped file, nothing is copied
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        try:
+            read_header(self.file)
+            self.map = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+
+        self.view = memoryview(self.map)
+        self.header = RecordingHeader.parse(self.map)
+        self.player_count = self.header.player_count
+
+    def close(self):
+        # only releases this object's own view: slices from record() share
+        # the mapping, and mmap.close() raises BufferError while any of them
+        # is alive. the file is closed either way
+        try:
+            self.view.release()
+            self.map.close()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def parse(self, krec):
+        # generated parser reading from the mapping through mmap.read: the
+        # map isn't copied, but every parsed field is a bytes copy of its
+        # own. records() and record() are the zero copy way
+        return krec(KaitaiStream(self.map))
+
+    def records(self) -> Iterator[tuple[int, int]]:
+        return scan_records(self.map)
+
+    def record(self, offset: int, length: int) -> memoryview:
+        # a slice of the mapping, callers drop or release() it before close
+        # and copy with bytes() whatever has to outlive the recording
+        return self.view[offset:offset+length]
+
+    def ports(self) -> Iterator[tuple[int, int, int, int, int, int]]:
+        # (frame, player_id, type, button, stick_x, stick_y) for every
+        # get_keys / read_controller port, unpacked in place from the map
+        data = self.map
+        count = self.player_count
+        frame = 0
+        for offset, length in scan_records(data):
+            if data[offset] != Event.VALUES:
+                continue
+
+            size = length - 3
+            width = size // count if count > 0 else 0
+            if width > 0:
+                end = offset + 3 + size - width + 1
+                for base in range(offset + 3, end, width):
+                    id, type = PORT_HEADER.unpack_from(data, base)
+                    pad = self.__pad_offset(data, base, type, width)
+                    if pad:
+                        yield (frame, id - PLAYER_ID_BASE, type,
+                               *OS_CONT_PAD.unpack_from(data, pad))
+            frame += 1
+
+    @staticmethod
+    def __pad_offset(data, base: int, type: int, width: int) -> int:
+        if type == PortType.GET_KEYS:
+            if width >= GET_KEYS_PAD + OS_CONT_PAD_SIZE:
+                return base + GET_KEYS_PAD
+
+        elif type == PortType.READ_CONTROLLER:
+            if width >= READ_CONTROLLER_PAD + OS_CONT_PAD_SIZE:
+                rx_len, tx = READ_CONTROLLER_PIF.unpack_from(
+                    data, base + READ_CONTROLLER_RX_LEN)
+                if tx == READ_VALUES and rx_len >= OS_CONT_PAD_SIZE:
+                    return base + READ_CONTROLLER_PAD
+        return 0
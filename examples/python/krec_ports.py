@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import yaml
+import numpy as np
+from dataclasses import asdict, dataclass, field
+from krec_frames import decode_file
+from krec_stream import PortType
+
+PLAYERS = 4
+
+
+@dataclass
+class PortOccupancy:
+    player_id: int
+    first_frame: int                # first values event with this port
+    last_frame: int
+    frames: int                     # values events with this port
+    input_frames: int               # ... with any button or stick input
+    types: list[str] = field(default_factory=list)
+    hot_plugs: list[dict] = field(default_factory=list)
+
+
+def _hot_plugs(frames: np.ndarray, total: int) -> list[dict]:
+    # frames with a controller answering (has_pad), gaps are unplugged
+    if not len(frames):
+        return []
+
+    events = []
+    if frames[0] > 0:
+        events.append((frames[0], 'plugged'))
+    for gap in np.flatnonzero(np.diff(frames) > 1):
+        events.append((frames[gap] + 1, 'unplugged'))
+        events.append((frames[gap + 1], 'plugged'))
+    if frames[-1] < total - 1:
+        events.append((frames[-1] + 1, 'unplugged'))
+    return [{'frame': int(frame), 'event': event} for frame, event in events]
+
+
+def _type_name(type: int) -> str:
+    try:
+        return PortType(type).name.lower()
+    except ValueError:
+        return str(type)
+
+
+def occupancy(ports: np.ndarray, total: int) -> dict[int, PortOccupancy]:
+    # ports as decoded by krec_frames, total is the number of values events
+    result = {}
+    for player_id in np.unique(ports['player_id']):
+        rows = ports[ports['player_id'] == player_id]
+        frames = np.unique(rows['frame'])
+        active = rows['has_pad'] & (
+            (rows['button'] != 0) | (rows['stick_x'] != 0) |
+            (rows['stick_y'] != 0))
+        types = [_type_name(type) for type in np.unique(rows['type'])]
+        result[int(player_id)] = PortOccupancy(
+            int(player_id), int(frames[0]), int(frames[-1]), len(frames),
+            len(np.unique(rows['frame'][active])), types,
+            _hot_plugs(np.unique(rows['frame'][rows['has_pad']]), total))
+    return result
+
+
+def plugged(ports: np.ndarray, players: int = PLAYERS) -> list[bool]:
+    # controllers to connect for the whole movie, any frame counts
+    ids = set(np.unique(ports['player_id']).tolist())
+    return [id in ids for id in range(1, players + 1)]
+
+
+def analyze_file(path: str) -> tuple[dict[int, PortOccupancy], int]:
+    ports = decode_file(path)
+    total = int(ports['frame'][-1]) + 1 if len(ports) else 0
+    return occupancy(ports, total), total
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Reports which controller ports are used over a whole recording'
+    ))
+    parser.add_argument('file', nargs='+', help='krec recording (*.krec)')
+    return parser.parse_args()
+
+
+def main(args):
+    for file in args.file:
+        try:
+            ports, frames = analyze_file(file)
+        except Exception as e:
+            print(f"Unable to open {file}: {e}")
+            continue
+
+        info = {
+            'krec': {
+                'name': file,
+                'frames': frames,
+                'ports': [asdict(port) for port in ports.values()],
+            }
+        }
+        yaml.dump(info, sys.stdout, sort_keys=False)
+        print()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+import yaml
+from collections import Counter
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from typing import Iterator
+from krec_stream import *
+
+# limits a damaged record can't hide behind; real text is far shorter and
+# values hold at most 8 ports of a few dozen bytes
+MAX_TEXT = 1024
+MAX_VALUES = 1024
+RESYNC_CHAIN = 4        # records that must follow a resync candidate
+EVENT_BYTES = re.compile(b'[\x08\x12\x14]')
+VALUES_BYTE = re.compile(b'\x12')
+
+INCOMPLETE = 0          # check_record: runs past the end of the data
+
+
+@dataclass
+class Damage:
+    offset: int
+    length: int
+    reason: str
+
+
+def check_record(buffer, pos: int,
+                 player_count: int = 0) -> tuple[int, str]:
+    # (length, '') of a plausible record at pos, otherwise (INCOMPLETE or
+    # -1, reason); reads at most MAX_TEXT or MAX_VALUES bytes. values must
+    # split evenly between player_count players, when it is known
+    end = len(buffer)
+    match buffer[pos]:
+        case Event.CHAT | Event.DROP as event:
+            texts = 2 if event == Event.CHAT else 1
+            cursor = pos + 1
+            for _ in range(texts):
+                limit = min(cursor + MAX_TEXT, end)
+                nul = buffer.find(b'\0', cursor, limit)
+                if nul < 0:
+                    if limit == end:
+                        return INCOMPLETE, 'truncated record'
+                    return -1, 'unterminated text'
+                cursor = nul + 1
+            length = cursor - pos + (4 if event == Event.DROP else 0)
+
+        case Event.VALUES:
+            if pos + 3 > end:
+                return INCOMPLETE, 'truncated record'
+            size = int.from_bytes(buffer[pos+1:pos+3], 'little', signed=True)
+            if not 0 <= size <= MAX_VALUES:
+                return -1, f"implausible values size {size}"
+            if player_count > 0 and size % player_count:
+                return -1, f"values size {size} not a multiple of " \
+                    f"{player_count} players"
+            length = 3 + size
+
+        case other:
+            return -1, f"unknown event type {other}"
+
+    if pos + length > end:
+        return INCOMPLETE, 'truncated record'
+    return length, ''
+
+
+class RecoveryScanner(object):
+    # one forward pass: records are taken as long as they check out, after
+    # damage the next event type byte that starts a chain of plausible
+    # records is where the scan picks up again. every offset is looked at
+    # a bounded number of times, so the scan stays linear
+    def __init__(self, buffer, offset: int = HEADER_SIZE,
+                 player_count: int = 0):
+        self.buffer = buffer
+        self.offset = offset
+        self.player_count = player_count
+        self.damage: list[Damage] = []
+        # no nul in nul_from..nul_at - 1, nul_at is one or the end
+        self.nul_from = self.nul_at = -1
+
+    def check(self, pos: int) -> tuple[int, str]:
+        return check_record(self.buffer, pos, self.player_count)
+
+    def __next_nul(self, start: int) -> int:
+        # remembered, candidates close together share the search
+        if not self.nul_from <= start <= self.nul_at:
+            self.nul_from = start
+            self.nul_at = self.buffer.find(b'\0', start)
+            if self.nul_at < 0:
+                self.nul_at = len(self.buffer)
+        return self.nul_at
+
+    def records(self) -> Iterator[tuple[int, int]]:
+        buffer, pos, end = self.buffer, self.offset, len(self.buffer)
+        while pos < end:
+            length, reason = self.check(pos)
+            if length > 0:
+                yield pos, length
+                pos += length
+                continue
+
+            resume = self.__resync(pos + 1) if length else end
+            self.damage.append(Damage(pos, resume - pos, reason))
+            pos = resume
+
+    def __resync(self, pos: int) -> int:
+        # a rejected chat or drop tells where the next nul is: text
+        # candidates before text_from can't reach it within MAX_TEXT, so
+        # only values candidates are tried there. a run of event bytes
+        # without a nul is crossed in one search instead of byte by byte
+        end = len(self.buffer)
+        text_from = pos
+        while pos < end:
+            if pos < text_from:
+                match = VALUES_BYTE.search(self.buffer, pos, text_from)
+                if not match:
+                    pos = text_from
+                    continue
+            elif not (match := EVENT_BYTES.search(self.buffer, pos)):
+                break
+
+            start = match.start()
+            if self.__chains(start):
+                return start
+            if self.buffer[start] != Event.VALUES:
+                text_from = max(text_from,
+                                self.__next_nul(start + 1) - MAX_TEXT - 1)
+            pos = start + 1
+        return end
+
+    def __chains(self, pos: int) -> bool:
+        end = len(self.buffer)
+        for _ in range(RESYNC_CHAIN):
+            if pos == end:
+                return True
+            length, _ = self.check(pos)
+            if length == INCOMPLETE:
+                return True         # the tail, reported as truncated
+            if length < 0:
+                return False
+            pos += length
+        return True
+
+
+@dataclass
+class RecoveryReport:
+    size: int
+    records: int
+    frames: int
+    damaged_bytes: int
+    frames_lost: int            # estimate from the usual values size
+    damage: list[Damage]
+
+    def to_dict(self) -> dict:
+        return {
+            'size': self.size,
+            'records': self.records,
+            'frames': self.frames,
+            'damaged bytes': self.damaged_bytes,
+            'estimated frames lost': self.frames_lost,
+            'damage': [asdict(damage) for damage in self.damage],
+        }
+
+
+def recover(data) -> tuple[bytes, RecoveryReport]:
+    # header and every plausible record, runs between damage copied whole
+    header = read_header(BytesIO(data[:HEADER_SIZE]))
+    player_count = RecordingHeader.parse(header).player_count
+    scanner = RecoveryScanner(data, player_count=player_count)
+    view = memoryview(data)
+    parts = [header]
+    records, frames = 0, 0
+    sizes = Counter()
+    start = stop = HEADER_SIZE
+    for offset, length in scanner.records():
+        if offset != stop:
+            parts.append(view[start:stop])
+            start = offset
+        stop = offset + length
+        records += 1
+        if data[offset] == Event.VALUES:
+            frames += 1
+            sizes[length] += 1
+    parts.append(view[start:stop])
+
+    damaged = sum(damage.length for damage in scanner.damage)
+    usual = sizes.most_common(1)[0][0] if sizes else 0
+    lost = -(-damaged // usual) if usual else 0
+    return b''.join(parts), RecoveryReport(
+        len(data), records, frames, damaged, lost, scanner.damage)
+
+
+def recover_file(path: str) -> tuple[bytes, RecoveryReport]:
+    with open(path, 'rb') as stream:
+        return recover(stream.read())
+
+
+def recovered_path(path: str) -> str:
+    base, ext = os.path.splitext(path)
+    return f"{base}.recovered{ext}"
+
+
+def salvage(path: str, output: str = None) -> tuple[str, RecoveryReport]:
+    # path itself when nothing is damaged, otherwise the salvaged copy
+    data, report = recover_file(path)
+    if not report.damage:
+        return path, report
+
+    output = output or recovered_path(path)
+    try:
+        with open(output, 'wb') as stream:
+            stream.write(data)
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    return output, report
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Salvages the readable events of truncated or corrupt Kaillera '
+        'recordings (*.krec)'
+    ))
+    parser.add_argument('file', nargs='+', help='krec recording (*.krec)')
+    parser.add_argument('-n', dest='dry_run', action='store_true',
+                        help='only report the damage, write nothing')
+    return parser.parse_args()
+
+
+def main(args):
+    for file in args.file:
+        try:
+            if args.dry_run:
+                output, report = None, recover_file(file)[1]
+            else:
+                output, report = salvage(file)
+        except Exception as e:
+            print(f"Unable to recover {file}: {e}")
+            continue
+
+        info = {'krec': {'name': file, **report.to_dict()}}
+        if report.damage and output:
+            info['krec']['recovered'] = output
+        yaml.dump(info, sys.stdout, sort_keys=False)
+        print()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from dataclasses import dataclass
+from enum import IntEnum
+from io import BytesIO
+from typing import BinaryIO, Iterator
+
+from kaitaistruct import KaitaiStream
+
+
+# krec.ksy: header (magic, app_name, game_name, time, player_id, player_count)
+HEADER_FORMAT = '<4s128s128siii'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAGIC = b'KRC0'
+
+CHUNK_SIZE = 64 * 1024
+PORTS = 4                           # controller ports of the console
+
+# decoded recordings (krec_cache) and other derived data
+CACHE_DIR = os.environ.get(
+    'KREC_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'krec'))
+
+
+class Event(IntEnum):
+    CHAT = 8
+    VALUES = 18
+    DROP = 20
+
+
+# krec_pj64k.ksy: port, offsets from the start of a port
+PORT_ID = 0
+PORT_TYPE = 1
+PLAYER_ID_BASE = 15                 # port.player_id = id - 15
+GET_KEYS_PAD = 12                   # unknown1, raw_data, plugin
+READ_CONTROLLER_RX_LEN = 5
+READ_CONTROLLER_TX = 6
+READ_CONTROLLER_PAD = 7             # unknown1, pif_tx_len, pif_rx_len, pif_tx
+READ_VALUES = 1                     # read_controller.pif_cmd.read_values
+OS_CONT_PAD_SIZE = 4
+
+
+# os_cont_pad instances, bit masks of the u2be button word
+OS_CONT_PAD_BUTTONS = {
+    'a_button': 0x8000,
+    'b_button': 0x4000,
+    'z_trig': 0x2000,
+    'start_button': 0x1000,
+    'u_dpad': 0x0800,
+    'd_dpad': 0x0400,
+    'l_dpad': 0x0200,
+    'r_dpad': 0x0100,
+    'reserved2': 0x0080,
+    'reserved1': 0x0040,
+    'l_trig': 0x0020,
+    'r_trig': 0x0010,
+    'u_cbutton': 0x0008,
+    'd_cbutton': 0x0004,
+    'l_cbutton': 0x0002,
+    'r_cbutton': 0x0001,
+}
+
+
+# an os_cont_pad without the parser objects behind it
+Pad = namedtuple('Pad', 'button stick_x stick_y')
+
+
+class PortType(IntEnum):
+    GET_KEYS = 32
+    READ_CONTROLLER = 33
+    APPLY_CHEAT = 36
+
+
+@dataclass
+class RecordingHeader:
+    app_name: str
+    game_name: str
+    time: int
+    player_id: int
+    player_count: int
+
+    @classmethod
+    def parse(cls, raw: bytes):
+        _, app_name, game_name, time, player_id, player_count = \
+            struct.unpack_from(HEADER_FORMAT, raw)
+        return cls(
+            app_name.split(b'\0', 1)[0].decode('utf-8', 'replace'),
+            game_name.split(b'\0', 1)[0].decode('utf-8', 'replace'),
+            time, player_id, player_count)
+
+
+@dataclass
+class Record:
+    offset: int
+    type: Event
+    raw: bytes
+
+
+def read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_header(stream: BinaryIO) -> bytes:
+    raw = read_exact(stream, HEADER_SIZE)
+    if raw[0:4] != MAGIC[0:len(raw)]:
+        raise ValueError(f"bad magic {raw[0:4]!r}, expected {MAGIC!r}")
+    if len(raw) < HEADER_SIZE:
+        raise EOFError(f"header is {len(raw)} of {HEADER_SIZE} bytes")
+    return raw
+
+
+def probe_header(path: str) -> RecordingHeader:
+    # a single header sized read, playback is never touched
+    with open(path, 'rb', buffering=0) as stream:
+        return RecordingHeader.parse(read_header(stream))
+
+
+def probe_ports(path: str) -> list[bool]:
+    # scan_ports over the mapped file, nothing is parsed or held
+    with open(path, 'rb') as stream:
+        header = RecordingHeader.parse(read_header(stream))
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return scan_ports(data, header.player_count)
+
+
+def read_array(stream: BinaryIO, typecode: str, count: int) -> array:
+    # arrays are stored little endian in every sidecar and cache file
+    data = array(typecode)
+    data.fromfile(stream, count)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data
+
+
+def write_array(stream: BinaryIO, data: array):
+    if sys.byteorder != 'little':
+        data = array(data.typecode, data)
+        data.byteswap()
+    data.tofile(stream)
+
+
+def record_length(buffer, pos: int = 0) -> int:
+    # returns 0 when the record at pos is not complete yet
+    end = len(buffer)
+    if pos >= end:
+        return 0
+
+    match buffer[pos]:
+        case Event.CHAT:
+            nickname = buffer.find(b'\0', pos + 1)
+            if nickname < 0:
+                return 0
+            message = buffer.find(b'\0', nickname + 1)
+            if message < 0:
+                return 0
+            length = message + 1 - pos
+
+        case Event.VALUES:
+            if pos + 3 > end:
+                return 0
+            size = int.from_bytes(buffer[pos+1:pos+3], 'little', signed=True)
+            if size < 0:
+                raise ValueError(f"negative values size {size}")
+            length = 3 + size
+
+        case Event.DROP:
+            nickname = buffer.find(b'\0', pos + 1)
+            if nickname < 0:
+                return 0
+            length = nickname + 5 - pos
+
+        case other:
+            raise ValueError(f"unknown event type {other}")
+
+    return length if pos + length <= end else 0
+
+
+def scan_records(buffer, pos: int = HEADER_SIZE) -> Iterator[tuple[int, int]]:
+    # (offset, length) of each record in an in-memory recording, no copies
+    end = len(buffer)
+    while pos < end:
+        length = record_length(buffer, pos)
+        if not length:
+            raise EOFError(
+                f"truncated record at offset {pos} ({end - pos} bytes)")
+        yield pos, length
+        pos += length
+
+
+def scan_ports(buffer, player_count: int, pos: int = HEADER_SIZE,
+               ports: int = PORTS) -> list[bool]:
+    # controller ports used anywhere in the recording, from the port id
+    # byte of each values event; stops once every port has been seen
+    plugged = [False] * ports
+    if player_count <= 0:
+        return plugged
+    for offset, length in scan_records(buffer, pos):
+        if buffer[offset] != Event.VALUES:
+            continue
+        width = (length - 3) // player_count
+        if width <= 0:
+            continue
+        end = offset + 3 + width * player_count
+        for base in range(offset + 3, end, width):
+            id = buffer[base + PORT_ID] - PLAYER_ID_BASE
+            if 1 <= id <= ports:
+                plugged[id-1] = True
+        if all(plugged):
+            break
+    return plugged
+
+
+class RecordScanner(object):
+    # splits raw playback bytes into records without parsing their contents
+    def __init__(self, offset: int = HEADER_SIZE):
+        self.offset = offset
+        self.buffer = bytearray()
+
+    @property
+    def pending(self) -> int:
+        return len(self.buffer)
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+    def records(self) -> Iterator[Record]:
+        pos = 0
+        try:
+            while length := record_length(self.buffer, pos):
+                raw = bytes(self.buffer[pos:pos+length])
+                yield Record(self.offset, Event(raw[0]), raw)
+                self.offset += length
+                pos += length
+        except ValueError as e:
+            raise ValueError(f"{e} at offset {self.offset}") from None
+        finally:
+            del self.buffer[:pos]
+
+
+def iter_records(stream: BinaryIO, offset: int = HEADER_SIZE,
+                 chunk_size: int = CHUNK_SIZE) -> Iterator[Record]:
+    scanner = RecordScanner(offset)
+    read = getattr(stream, 'read1', stream.read)
+    while data := read(chunk_size):
+        scanner.feed(data)
+        yield from scanner.records()
+
+    if scanner.pending:
+        raise EOFError(
+            f"truncated record at offset {scanner.offset} "
+            f"({scanner.pending} bytes)")
+
+
+class PlaybackStream(object):
+    # yields Playback events one at a time instead of the repeat: eos list
+    def __init__(self, krec, stream: BinaryIO):
+        self.krec = krec
+        self.stream = stream
+        self.offset = HEADER_SIZE
+
+        # playback only needs _root.header (values uses player_count)
+        self.root = krec.__new__(krec)
+        self.root._io = KaitaiStream(BytesIO(read_header(stream)))
+        self.root._parent = None
+        self.root._root = self.root
+        self.root.header = krec.Header(self.root._io, self.root, self.root)
+
+    @classmethod
+    def from_file(cls, krec, path: str):
+        stream = open(path, 'rb')
+        try:
+            return cls(krec, stream)
+        except Exception:
+            stream.close()
+            raise
+
+    @property
+    def header(self):
+        return self.root.header
+
+    def parse(self, record: Record):
+        io = KaitaiStream(BytesIO(record.raw))
+        return self.krec.Playback(io, self.root, self.root)
+
+    def records(self) -> Iterator[Record]:
+        return iter_records(self.stream, self.offset)
+
+    def seek(self, offset: int):
+        # offset must be a record boundary (see krec_index)
+        self.stream.seek(offset)
+        self.offset = offset
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        for record in self.records():
+            yield self.parse(record)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+from krec_writer import *
+
+
+DEFAULT_APP_NAME = 'Project64k 0.13 (01 Aug 2003)'
+DEFAULT_GAME_NAME = 'SUPER SMASH BROS.'
+PORT_SIZE = max(GET_KEYS_SIZE, READ_CONTROLLER_SIZE, APPLY_CHEAT_SIZE)
+
+# reserved1 / reserved2 have no bk2 key and can't survive a round trip
+MAPPED_BUTTONS = 0xffff & ~(
+    OS_CONT_PAD_BUTTONS['reserved1'] | OS_CONT_PAD_BUTTONS['reserved2'])
+
+
+def pack_port(rng: random.Random, player_id: int, type: PortType,
+              pad: tuple[int, int, int], size: int, raw: bool) -> bytes:
+    if raw:
+        # krec.ksy ports are opaque after id / type
+        return bytes([0, 0]) + rng.randbytes(size - 2)
+
+    match type:
+        case PortType.GET_KEYS:
+            return pack_get_keys(player_id, *pad, size=size)
+        case PortType.READ_CONTROLLER:
+            return pack_read_controller(player_id, *pad, size=size)
+        case PortType.APPLY_CHEAT:
+            return pack_apply_cheat(
+                player_id, rng.randrange(16), rng.randrange(16), 0x80,
+                rng.getrandbits(8), size=size)
+
+
+def write_recording(path: str, frames: int, players: int = 2,
+                    chat_interval: int = 0, seed: int = 0,
+                    game_name: str = DEFAULT_GAME_NAME, drops: int = 0,
+                    port_types: list[PortType] = [PortType.GET_KEYS],
+                    raw: bool = False) -> int:
+    # inputs are held for a few frames like real play, port types are
+    # assigned to players round robin, drops are spread over the recording
+    rng = random.Random(seed)
+    pads = [(0, 0, 0)] * players
+    drop_interval = frames // (drops + 1) if drops else 0
+    size = GET_KEYS_SIZE if port_types == [PortType.GET_KEYS] and not raw \
+        else PORT_SIZE
+
+    with open(path, 'wb') as stream:
+        writer = KrecWriter(stream, DEFAULT_APP_NAME, game_name,
+                            1600000000, 1, players)
+        for frame in range(frames):
+            if chat_interval and frame % chat_interval == chat_interval - 1:
+                writer.chat(f"player{rng.randrange(players) + 1}",
+                            f"message {frame}")
+
+            if drop_interval and frame and frame % drop_interval == 0 and \
+                    frame // drop_interval <= drops:
+                player = (frame // drop_interval - 1) % players + 1
+                writer.drop(f"player{player}", player)
+
+            pads = [
+                pad if rng.random() < 0.8 else (
+                    rng.getrandbits(16) & MAPPED_BUTTONS,
+                    rng.randint(-80, 80), rng.randint(-80, 80))
+                for pad in pads
+            ]
+            writer.values([
+                pack_port(rng, player + 1,
+                          port_types[player % len(port_types)], pad, size, raw)
+                for player, pad in enumerate(pads)
+            ])
+        return stream.tell()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Generates a synthetic Kaillera recording (*.krec)'
+    ))
+    port_types = [type.name.lower() for type in PortType]
+
+    parser.add_argument('output', help='recording to write (*.krec)')
+    parser.add_argument('-f', metavar='FRAMES', type=int, dest='frames',
+                        help='values events to write (default: 3600)')
+    parser.add_argument('-p', metavar='PLAYERS', type=int, dest='players',
+                        help='player count (default: 2)')
+    parser.add_argument('-c', metavar='INTERVAL', type=int, dest='chats',
+                        help='frames between chat messages (default: none)')
+    parser.add_argument('-d', metavar='DROPS', type=int, dest='drops',
+                        help='drop events to write (default: 0)')
+    parser.add_argument('-t', metavar='TYPE', dest='types', nargs='+',
+                        choices=port_types,
+                        help='port types, assigned to players in turn '
+                        '(default: get_keys)')
+    parser.add_argument('-s', metavar='SEED', type=int, dest='seed',
+                        help='random seed (default: 0)')
+    parser.add_argument('--krec', action='store_true', dest='raw',
+                        help='write opaque krec.ksy ports instead of PJ64K')
+
+    parser.set_defaults(frames=3600, players=2, chats=0, drops=0,
+                        types=['get_keys'], seed=0)
+    return parser.parse_args()
+
+
+def main(args):
+    types = [PortType[type.upper()] for type in args.types]
+    size = write_recording(
+        args.output, args.frames, args.players, args.chats, args.seed,
+        drops=args.drops, port_types=types, raw=args.raw)
+    print(f"{args.output}: {args.frames} frames, {size} bytes")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
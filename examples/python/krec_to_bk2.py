@@ -1,50 +1,301 @@
 #!/usr/bin/env python3
 
 import argparse
+import io
+import itertools
+import os
+import sys
+import time
+from typing import Iterable, Iterator, Optional
 from bizhawk import *
+from krec_dispatch import *
+from krec_metrics import Metrics
+from krec_stream import CACHE_DIR, Event, OS_CONT_PAD_BUTTONS, PORTS, Pad, \
+    PlaybackStream, probe_ports
 from lib.krec_pj64k import KrecPj64k as Krec
 from lib.krec_pj64k import *
 
 
+def batch(args):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    jobs = batch_jobs(args)
+    missing = [krec for krec, rom in jobs if not rom]
+    if missing:
+        print(f"No ROM given for {', '.join(missing)}")
+        exit(1)
+
+    # hash each ROM once, workers reuse the digest
+    digests = {}
+    for rom in set(rom for _, rom in jobs):
+        try:
+            digests[rom] = Game('', rom).sha1()
+        except OSError as e:
+            print(f"Unable to hash {rom}: {e}")
+            digests[rom] = ''
+
+    failed, frames, size = 0, 0, 0
+    metrics = Metrics()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for krec, rom in jobs:
+            future = executor.submit(
+                batch_convert, krec, rom, args.ver, args.core, digests[rom],
+                bool(args.metrics))
+            futures[future] = krec
+
+        for future in as_completed(futures):
+            krec = futures[future]
+            try:
+                output, count, stages = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"FAIL {krec}: {e}")
+                continue
+
+            metrics.merge(stages)
+            frames += count
+            size += os.path.getsize(krec)
+            print(f"OK {krec} -> {output} ({count} frames)")
+
+    elapsed = time.perf_counter() - start
+    converted = len(jobs) - failed
+    print(
+        f"{converted} of {len(jobs)} converted, {failed} failed in "
+        f"{elapsed:.2f}s ({converted/elapsed:.2f} files/s, "
+        f"{frames/elapsed:.0f} frames/s, "
+        f"{size/elapsed/1024/1024:.2f} MiB/s)")
+    if args.metrics:
+        print_metrics(metrics, args.metrics)
+    if failed:
+        exit(1)
+
+
+def batch_convert(krec_path: str, rom_path: str, ver: float,
+                  core: BizHawk.Core, digest: str,
+                  measure: bool) -> tuple[str, int, dict]:
+    # kaitai errors hold their stream and can't be sent back to the parent
+    metrics = Metrics(enabled=measure)
+    try:
+        output, count = convert(krec_path, rom_path, ver, core, digest,
+                                metrics)
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    return output, count, metrics.to_dict()['stages']
+
+
+def batch_jobs(args) -> list[tuple[str, str]]:
+    if args.dir:
+        return [(os.path.join(args.dir, name), args.rom)
+                for name in sorted(os.listdir(args.dir))
+                if name.lower().endswith('.krec')]
+
+    with open(args.manifest, 'r') as manifest:
+        return list(manifest_jobs(manifest, args.rom))
+
+
+def manifest_jobs(lines, default_rom: str) -> Iterator[tuple[str, str]]:
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        krec, _, rom = line.partition(',')
+        yield krec.strip(), rom.strip() or default_rom
+
+
+def convert(krec_path: str, rom_path: str, ver: float, core: BizHawk.Core,
+            digest: str = '', metrics: Metrics = None) -> tuple[str, int]:
+    metrics = metrics or Metrics(enabled=False)
+
+    # every frame is checked for controllers, not just the first ones, by
+    # a raw scan of the port ids so the frames can stream afterwards
+    with metrics.stage('determine_ports'):
+        ports = probe_ports(krec_path)
+
+    with PlaybackStream.from_file(Krec, krec_path) as playback:
+        return convert_playback(playback, krec_path, f"{krec_path}.bk2",
+                                rom_path, ver, core, digest, ports=ports,
+                                metrics=metrics)
+
+
+def convert_playback(playback: PlaybackStream, original: str, output: str,
+                     rom_path: str, ver: float, core: BizHawk.Core,
+                     digest: str = '', handlers: tuple[Handler, ...] = (),
+                     data: io.BytesIO = None, ports: list[bool] = None,
+                     hold: int = 100,
+                     metrics: Metrics = None) -> tuple[str, int]:
+    metrics = metrics or Metrics(enabled=False)
+    rom = load_rom(playback.header.game_name, rom_path, digest, metrics)
+
+    # single pass: chats and stats are collected while frames stream
+    # into the bk2. unless the ports are known, the first hold frames (all
+    # of them for 0) are kept as pads to detect them
+    stats = StatsCounter()
+    chats = ChatCollector(parse_message)
+    detector = PortDetector(limit=hold)
+    if ports is None:
+        handlers = (detector, *handlers)
+    dispatcher = Dispatcher(stats, chats, *handlers)
+
+    records = metrics.iterate(
+        'read', playback.records(), lambda record: len(record.raw))
+    events = metrics.iterate('parse', map(playback.parse, records))
+    values = metrics.iterate(
+        'dispatch', dispatcher.select(events, Event.VALUES))
+    head = []
+    if ports is None:
+        held = itertools.islice(values, hold) if hold else values
+        with metrics.stage('determine_ports'):
+            head = [read_pads(playback, copy=True) for _, playback in held]
+        ports = detector.plugged
+
+    bizhawk = BizHawk(ver=ver, core=core, game=rom, ports=ports)
+    bizhawk.subtitles = chats.messages
+    frames = itertools.chain(
+        head, (read_pads(playback) for _, playback in values))
+    inputs = metrics.iterate('parse_inputs', render_inputs(
+        frames, krec_mapping(bizhawk)))
+
+    with metrics.stage('build_bk2') as stage:
+        output = bizhawk.build_bk2(original, inputs, output, data)
+        stage.bytes_written += os.path.getsize(output)
+    return output, stats.counts[Event.VALUES]
+
+
+def convert_cached(cache, krec_path: str, rom_path: str, ver: float,
+                   core: BizHawk.Core, digest: str = '',
+                   metrics: Metrics = None) -> tuple[str, int]:
+    # frames, chats and ports come from the decoded columns of a
+    # krec_cache entry, the recording is only read to go into the bk2
+    metrics = metrics or Metrics(enabled=False)
+    with metrics.stage('cache'):
+        cached = cache.get(krec_path, 'krec_pj64k')
+    rom = load_rom(cached.header.game_name, rom_path, digest, metrics)
+
+    bizhawk = BizHawk(ver=ver, core=core, game=rom, ports=cached.plugged)
+    bizhawk.subtitles = [
+        Subtitle(index, f"<{nickname}> {message}")
+        for index, nickname, message in cached.chats
+    ]
+    inputs = metrics.iterate('parse_inputs', render_inputs(
+        cached.pads(), krec_mapping(bizhawk)))
+
+    with metrics.stage('build_bk2') as stage:
+        output = bizhawk.build_bk2(krec_path, inputs, f"{krec_path}.bk2")
+        stage.bytes_written += os.path.getsize(output)
+    return output, cached.types.count(Event.VALUES)
+
+
+def load_rom(game_name: str, rom_path: str, digest: str,
+             metrics: Metrics) -> Game:
+    rom = Game(game_name, rom_path, digest)
+    check_rom(rom)
+    with metrics.stage('sha1') as stage:
+        # only a ROM that is actually hashed counts as read
+        if not rom.digest and not rom_hash_cache().lookup(rom_path):
+            stage.bytes_read += os.path.getsize(rom_path)
+        rom.sha1()
+    return rom
+
+
+def check_rom(rom: Game):
+    # only a warning, and skipped when the ROM can't be read (callers with a
+    # known digest may not pass one)
+    if not rom.rom_path:
+        return
+    try:
+        if rom.matches():
+            return
+        rom_name = rom.rom_name() or 'no N64 header'
+    except OSError:
+        return
+    print(f"Warning: {rom.rom_path} ({rom_name}) may not be {rom.name}",
+          file=sys.stderr)
+
+
+def data_attr(map: Bk2Map) -> str:
+    match map.bk2_key:
+        case 'Y Axis' | 'X Axis':
+            return 'stick_y' if map.y_axis else 'stick_x'
+
+        case 'A Up' | 'A Down' | 'A Left' | 'A Right':
+            return ''  # unused
+
+        case 'DPad U' | 'DPad D' | 'DPad L' | 'DPad R':
+            direction = map.bk2_key.split(' ')[1]
+            return f"{direction.lower()}_dpad"
+
+        case 'Start' | 'B' | 'A':
+            return f"{map.bk2_key.lower()}_button"
+
+        case 'Z' | 'L' | 'R':
+            return f"{map.bk2_key.lower()}_trig"
+
+        case 'C Up' | 'C Down' | 'C Left' | 'C Right':
+            direction = map.bk2_key.split(' ')[1][0]
+            return f"{direction.lower()}_cbutton"
+    return ''
+
+
 def determine_ports(values: list[tuple[int, Krec.Playback]]):
-    plugged = [False, False, False, False]
-    playback: Krec.Playback
-    for _, playback in values:
-        ports: list[Krec.Port] = playback.data.values.ports
-        for port in ports:
-            if port.player_id in range(1, 4, 1):
-                plugged[port.player_id-1] = True
-    return plugged
+    detector = PortDetector()
+    Dispatcher(detector).run(playback for _, playback in values)
+    return detector.plugged
 
 
 def krec_mapping(bizhawk: BizHawk):
+    # the input log is frozen, a compiled copy reading Pad attributes
+    # replaces bizhawk's
     mapping = bizhawk.input_log
+    keys = []
     input: Inputs
     map: Bk2Map
     for input in mapping.keys:
         if input:
+            maps = []
             for map in input.maps:
-                match map.bk2_key:
-                    case 'Y Axis' | 'X Axis':
-                        map.data_attr = 'stick_y' if map.y_axis else 'stick_x'
+                attr = data_attr(map)
+                maps.append(map.replace(
+                    data_attr=attr,
+                    data_mask=OS_CONT_PAD_BUTTONS.get(attr, 0)))
+            input = input.replace(maps=tuple(maps))
+        keys.append(input)
 
-                    case 'A Up' | 'A Down' | 'A Left' | 'A Right':
-                        map.data_attr = ''  # unused
+    bizhawk.input_log = mapping.replace(keys=tuple(keys))
+    return bizhawk.input_log
 
-                    case 'DPad U' | 'DPad D' | 'DPad L' | 'DPad R':
-                        direction = map.bk2_key.split(' ')[1]
-                        map.data_attr = f"{direction.lower()}_dpad"
 
-                    case 'Start' | 'B' | 'A':
-                        map.data_attr = f"{map.bk2_key.lower()}_button"
+def recover(krec_path: str) -> str:
+    # converts the salvaged copy of a damaged recording, see krec_recover
+    from krec_recover import salvage
 
-                    case 'Z' | 'L' | 'R':
-                        map.data_attr = f"{map.bk2_key.lower()}_trig"
+    path, report = salvage(krec_path)
+    for damage in report.damage:
+        print(f"Damaged {krec_path} at {damage.offset} ({damage.length} "
+              f"bytes): {damage.reason}", file=sys.stderr)
+    if report.damage:
+        print(f"Salvaged {report.frames} frames to {path}, about "
+              f"{report.frames_lost} lost", file=sys.stderr)
+    return path
 
-                    case 'C Up' | 'C Down' | 'C Left' | 'C Right':
-                        direction = map.bk2_key.split(' ')[1][0]
-                        map.data_attr = f"{direction.lower()}_cbutton"
-    return mapping
+
+def resident(args):
+    # one process for a stream of recordings, imports and settings are
+    # paid once instead of once per file
+    failed = 0
+    for krec, rom in manifest_jobs(sys.stdin, args.rom):
+        try:
+            if not rom:
+                raise ValueError('no ROM given')
+            output, count = convert(krec, rom, args.ver, args.core)
+        except Exception as e:
+            failed += 1
+            print(f"FAIL {krec}: {e}", flush=True)
+            continue
+        print(f"OK {krec} -> {output} ({count} frames)", flush=True)
+    if failed:
+        exit(1)
 
 
 def parse_arguments():
@@ -52,12 +303,40 @@ def parse_arguments():
         'Converts a Kaillera recording (*.krec) to a Bizhawk TAS (*.bk2)'
     ))
 
-    parser.add_argument('-k', metavar='KREC', required=True, dest='krec',
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-k', metavar='KREC', dest='krec',
                         help='Kaillera recording file (*.krec)')
-    parser.add_argument('-r', metavar='ROM', required=True, dest='rom',
+    source.add_argument('-d', metavar='DIR', dest='dir',
+                        help='convert every recording (*.krec) in DIR')
+    source.add_argument('-f', metavar='MANIFEST', dest='manifest',
+                        help='convert recordings listed in MANIFEST, one '
+                        '"KREC[,ROM]" per line; with -, read them from '
+                        'stdin and convert each as it arrives')
+
+    parser.add_argument('-r', metavar='ROM', required=False, dest='rom',
                         help='ROM file used with the recording (*.z64)')
     parser.add_argument('-v', metavar='VERSION', required=False, dest='ver',
                         help='BizHawk emulator version (default: 2.8)')
+    parser.add_argument('-j', metavar='JOBS', required=False, dest='jobs',
+                        type=int, help='batch worker processes '
+                        '(default: cpu count)')
+    parser.add_argument('-M', metavar='FORMAT', required=False,
+                        dest='metrics', choices=('json', 'prometheus'),
+                        help='print per stage metrics to stderr as json '
+                        'or prometheus text')
+    parser.add_argument('-R', required=False, dest='recover',
+                        action='store_true', help='salvage a damaged '
+                        'recording (to KREC.recovered.krec) and convert that '
+                        '(-k only)')
+    parser.add_argument('-P', metavar='DIR', required=False, dest='profile',
+                        help='write cProfile and tracemalloc reports per '
+                        'stage to DIR (-k only)')
+    parser.add_argument('-c', required=False, dest='cache',
+                        action='store_true', help='reuse the decoded '
+                        'frames of the recording from a cache (-k only)')
+    parser.add_argument('-C', metavar='DIR', required=False,
+                        dest='cache_dir', help='cache directory, implies '
+                        f"-c (default: {CACHE_DIR})")
 
     cores = parser.add_argument_group('cores')
     core = cores.add_mutually_exclusive_group()
@@ -68,61 +347,108 @@ def parse_arguments():
             value[0], required=False, dest='core', action='store_const',
             help=f"Use {value[1]} Core", const=BizHawk.Core(value))
 
-    parser.set_defaults(ver=2.8, core=BizHawk.Core.MUPEN64PLUS)
-    return parser.parse_args()
+    parser.set_defaults(ver=2.8, core=BizHawk.Core.MUPEN64PLUS,
+                        jobs=os.cpu_count())
+    args = parser.parse_args()
+    if args.cache_dir:
+        args.cache = True
+    single = [flag for flag, used in (('-R', args.recover),
+                                      ('-P', args.profile),
+                                      ('-c/-C', args.cache)) if used]
+    if single and not args.krec:
+        parser.error(f"{', '.join(single)} can only be used with -k KREC")
+    if args.jobs < 1:
+        parser.error('-j JOBS must be at least 1')
+    if not args.rom and not args.manifest:
+        parser.error('-r ROM is required unless using -f MANIFEST')
+    return args
+
+
+def print_metrics(metrics: Metrics, format: str):
+    if format == 'prometheus':
+        print(metrics.to_prometheus('krec_to_bk2'), end='', file=sys.stderr)
+    else:
+        print(metrics.to_json(), file=sys.stderr)
 
 
 def parse_inputs(values, input_log: InputLog, plugged: list[bool]):
-    inputs = []
-    playback: Krec.Playback
-    for _, playback in values:
-        data = [None] * 4
-        ports: list[Krec.Port] = playback.data.values.ports
-        port: Krec.Port
+    # plugged is already part of input_log, kept for existing callers
+    return render_inputs((read_pads(playback) for _, playback in values),
+                         input_log)
+
+
+def read_pads(playback: Krec.Playback, copy: bool = False) -> list:
+    # os_cont_pad by port, copied to a Pad to outlive the parser; ports
+    # with a player id outside the console's are dropped
+    data = [None] * PORTS
+    ports: list[Krec.Port] = playback.data.values.ports
+    port: Krec.Port
 
-        for port in ports:
-            if port.type == Krec.Port.Type.get_keys:
-                data[port.player_id-1] = port.data.os_cont_pad
+    for port in ports:
+        if port.type in (Krec.Port.Type.get_keys,
+                         Krec.Port.Type.read_controller):
+            if not 1 <= port.player_id <= PORTS:
+                continue
+            pad = port.data.os_cont_pad
+            if copy and pad is not None:
+                pad = Pad(pad.button, pad.stick_x, pad.stick_y)
+            data[port.player_id-1] = pad
+    return data
 
-            if port.type == Krec.Port.Type.read_controller:
-                data[port.player_id-1] = port.data.os_cont_pad
 
-        inputs.append(input_log.__str__(data, sum(plugged)))
-    return inputs
+def render_inputs(frames: Iterable[list[Optional[Pad]]],
+                  input_log: InputLog):
+    for data in frames:
+        yield input_log.__str__(data)
+
+
+def parse_message(frame: int, message: Krec.Playback):
+    text = f"<{message.data.nickname}> {message.data.message}"
+    return Subtitle(frame, text)
 
 
 def parse_messages(messages):
     subtitles = []
     message: Krec.Playback
     for frame, message in messages:
-        text = f"<{message.data.nickname}> {message.data.message}"
-        subtitles.append(Subtitle(frame, text))
+        subtitles.append(parse_message(frame, message))
 
     return subtitles
 
 
 def main(args):
+    if args.manifest == '-':
+        resident(args)
+        return
+    if not args.krec:
+        batch(args)
+        return
+
+    metrics = Metrics(enabled=bool(args.metrics or args.profile),
+                      trace_memory=bool(args.profile),
+                      profile=bool(args.profile))
     try:
-        krec = Krec.from_file(args.krec)
-        rom = Game(krec.header.game_name, args.rom)
+        krec = args.krec
+        if args.recover:
+            krec = recover(krec)
+        if args.cache:
+            from krec_cache import RecordingCache
+            with RecordingCache(args.cache_dir or CACHE_DIR) as cache:
+                output, _ = convert_cached(cache, krec, args.rom, args.ver,
+                                           args.core, metrics=metrics)
+        else:
+            output, _ = convert(krec, args.rom, args.ver, args.core,
+                                metrics=metrics)
     except Exception as e:
         print(e)
         exit(1)
-
-    # after 100 frames we should have enough info
-    chats = [(frame, event) for frame, event in enumerate(krec.playback)
-             if event.type == Krec.Playback.Event.chat]
-    values = [(frame, event) for frame, event in enumerate(krec.playback)
-              if event.type == Krec.Playback.Event.values]
-    ports = determine_ports(values[0:100])
-
-    bizhawk = BizHawk(ver=args.ver, core=args.core, game=rom, ports=ports)
-    inputs = parse_inputs(values, krec_mapping(bizhawk), ports)
-    bizhawk.subtitles = parse_messages(chats)
-
-    output = bizhawk.build_bk2(args.krec, inputs, f"{args.krec}.bk2")
     print(output)
 
+    if args.metrics:
+        print_metrics(metrics, args.metrics)
+    if args.profile:
+        metrics.dump(args.profile)
+
 
 if __name__ == "__main__":
     args = parse_arguments()
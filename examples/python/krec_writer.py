@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import struct
+from typing import BinaryIO
+from krec_stream import *
+
+
+GET_KEYS_FORMAT = struct.Struct('<bbhII')
+READ_CONTROLLER_FORMAT = struct.Struct('<bbhBBB')
+APPLY_CHEAT_FORMAT = struct.Struct('<bbHIIII')
+OS_CONT_PAD_FORMAT = struct.Struct('>Hbb')
+
+GET_KEYS_SIZE = GET_KEYS_FORMAT.size + OS_CONT_PAD_FORMAT.size
+READ_CONTROLLER_SIZE = READ_CONTROLLER_FORMAT.size + OS_CONT_PAD_FORMAT.size
+APPLY_CHEAT_SIZE = APPLY_CHEAT_FORMAT.size
+
+
+def pack_header(app_name: str, game_name: str, time: int, player_id: int,
+                player_count: int) -> bytes:
+    return struct.pack(
+        HEADER_FORMAT, MAGIC, app_name.encode('utf-8'),
+        game_name.encode('utf-8'), time, player_id, player_count)
+
+
+def pack_chat(nickname: str, message: str) -> bytes:
+    return (bytes([Event.CHAT]) + nickname.encode('utf-8') + b'\0' +
+            message.encode('utf-8') + b'\0')
+
+
+def pack_drop(nickname: str, player_id: int) -> bytes:
+    return (bytes([Event.DROP]) + nickname.encode('utf-8') + b'\0' +
+            struct.pack('<i', player_id))
+
+
+def pack_values(ports: list[bytes]) -> bytes:
+    # every port must be the same size, values splits on size / count
+    data = b''.join(ports)
+    return struct.pack('<bh', Event.VALUES, len(data)) + data
+
+
+def pack_get_keys(player_id: int, button: int, stick_x: int, stick_y: int,
+                  raw_data: int = 0, plugin: int = 0,
+                  size: int = GET_KEYS_SIZE) -> bytes:
+    port = (
+        GET_KEYS_FORMAT.pack(player_id + PLAYER_ID_BASE, PortType.GET_KEYS,
+                             0, raw_data, plugin) +
+        OS_CONT_PAD_FORMAT.pack(button, stick_x, stick_y))
+    return port.ljust(size, b'\0')
+
+
+def pack_read_controller(player_id: int, button: int, stick_x: int,
+                         stick_y: int,
+                         size: int = READ_CONTROLLER_SIZE) -> bytes:
+    port = (
+        READ_CONTROLLER_FORMAT.pack(
+            player_id + PLAYER_ID_BASE, PortType.READ_CONTROLLER, 0, 1,
+            OS_CONT_PAD_SIZE, READ_VALUES) +
+        OS_CONT_PAD_FORMAT.pack(button, stick_x, stick_y))
+    return port.ljust(size, b'\0')
+
+
+def pack_apply_cheat(player_id: int, cheat_id: int, code_id: int,
+                     command: int, value: int,
+                     size: int = APPLY_CHEAT_SIZE) -> bytes:
+    port = APPLY_CHEAT_FORMAT.pack(
+        player_id + PLAYER_ID_BASE, PortType.APPLY_CHEAT, 0, cheat_id,
+        code_id, command, value)
+    return port.ljust(size, b'\0')
+
+
+class KrecWriter(object):
+    def __init__(self, stream: BinaryIO, app_name: str, game_name: str,
+                 time: int, player_id: int, player_count: int):
+        self.stream = stream
+        self.events = 0
+        self.frames = 0
+        self.player_count = player_count
+        stream.write(pack_header(
+            app_name, game_name, time, player_id, player_count))
+
+    def chat(self, nickname: str, message: str):
+        self.stream.write(pack_chat(nickname, message))
+        self.events += 1
+
+    def drop(self, nickname: str, player_id: int):
+        self.stream.write(pack_drop(nickname, player_id))
+        self.events += 1
+
+    def values(self, ports: list[bytes]):
+        if len(ports) != self.player_count:
+            raise ValueError(
+                f"expected {self.player_count} ports, got {len(ports)}")
+        self.stream.write(pack_values(ports))
+        self.events += 1
+        self.frames += 1
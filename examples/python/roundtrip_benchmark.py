@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import bk2_to_krec
+import krec_to_bk2
+from bizhawk import BizHawk
+from krec_mmap import MappedRecording
+from krec_stream import Event
+from krec_synth import MAPPED_BUTTONS, write_recording
+
+
+def chats(recording: MappedRecording) -> list[tuple[int, bytes]]:
+    return [
+        (event, bytes(recording.record(offset, length)))
+        for event, (offset, length) in enumerate(recording.records())
+        if recording.map[offset] == Event.CHAT
+    ]
+
+
+def compare(original: str, converted: str) -> dict:
+    with MappedRecording(original) as a, MappedRecording(converted) as b:
+        ports = list(a.ports())
+        mismatched = sum(
+            1 for x, y in zip(ports, b.ports())
+            if x[:3] != y[:3] or
+            (x[3] & MAPPED_BUTTONS, *x[4:]) != (y[3], *y[4:]))
+        missing = len(ports) - sum(1 for _ in b.ports())
+        return {
+            'ports': len(ports),
+            'mismatched ports': mismatched + abs(missing),
+            'chats': sum(1 for offset, _ in a.records()
+                         if a.map[offset] == Event.CHAT),
+            'chats matched': chats(a) == chats(b),
+        }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=(
+        'Times krec -> bk2 -> krec on a synthetic recording'
+    ))
+    parser.add_argument('-f', metavar='FRAMES', type=int, dest='frames',
+                        help='frames to generate (default: 216000)')
+    parser.add_argument('-p', metavar='PLAYERS', type=int, dest='players',
+                        help='players to generate (default: 2)')
+    parser.add_argument('-c', metavar='INTERVAL', type=int, dest='chats',
+                        help='frames between chat messages (default: 600)')
+    parser.add_argument('-o', metavar='JSON', dest='output',
+                        help='also write the results to JSON')
+    parser.set_defaults(frames=216000, players=2, chats=600)
+    return parser.parse_args()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        original = os.path.join(tmpdir, 'original.krec')
+        converted = os.path.join(tmpdir, 'converted.krec')
+        size = write_recording(original, args.frames, args.players, args.chats)
+
+        start = time.perf_counter()
+        bk2, _ = krec_to_bk2.convert(
+            original, '', 2.8, BizHawk.Core.MUPEN64PLUS, '0' * 40)
+        to_bk2 = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bk2_to_krec.convert(bk2, converted, start_time=1600000000)
+        to_krec = time.perf_counter() - start
+
+        results = {
+            'frames': args.frames,
+            'players': args.players,
+            'krec bytes': size,
+            'bk2 bytes': os.path.getsize(bk2),
+            'krec_to_bk2': {
+                'seconds': round(to_bk2, 3),
+                'frames/s': round(args.frames / to_bk2),
+            },
+            'bk2_to_krec': {
+                'seconds': round(to_krec, 3),
+                'frames/s': round(args.frames / to_krec),
+            },
+            'fidelity': compare(original, converted),
+        }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)